@@ -8,7 +8,15 @@ import indigo
 import threading
 import time
 import json
+import os
+import re
+import sys
+import heapq
+from collections import deque, OrderedDict
+from itertools import count, islice
 from itertools import groupby
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 
 # Note the "indigo" module is automatically imported and made available inside
 # our global name space by the host process.
@@ -24,6 +32,8 @@ kVarSepChar     = "_"
 kGroupSepChar   = ","
 kBaseReserved   = (kBaseChar,kStateChar,kContextChar,kExitChar,kVarSepChar,kGroupSepChar)
 kStateReserved  = (kBaseChar,kContextChar,kExitChar,kVarSepChar,kGroupSepChar)
+kBaseReservedRe  = re.compile("[" + re.escape("".join(kBaseReserved)) + "]")
+kStateReservedRe = re.compile("[" + re.escape("".join(kStateReserved)) + "]")
 kPriorSuffix    = "__PriorState"
 kChangedSuffix  = "__LastChange"
 kContextSuffix  = "__Contexts"
@@ -32,6 +42,30 @@ kContextExtra   = "__Context__"
 kEnter   = True
 kExit    = False
 
+kStateKey       = "state"
+kTimerKey       = "timer"
+kBatchActions   = ('enterNewState','variableToState','revertToPriorState','addContext','removeContext','toggleContext')
+kPlanCacheSize  = 64
+kValidCacheSize = 256
+kTimerWorkers   = 4
+
+kNamespaceOptions = {
+    'coalesce'  : False,
+    'debounce'  : 0.0,
+    'dwell'     : 0.0,
+    'sourceVarId' : 0,
+    }
+
+kJournalFile    = "namespaces.journal"
+kSnapshotFile   = "namespaces.snapshot"
+kJournalCompact = 500
+
+kWriteInterval  = 0.1
+
+kMetricsFile    = "metrics.json"
+kMetricsBounds  = (0.0005,0.001,0.002,0.005,0.01,0.02,0.05,0.1,0.2,0.5,1.0,2.0,5.0,10.0)
+kMetricsHooks   = 100
+
 ################################################################################
 class Plugin(indigo.PluginBase):
 
@@ -47,45 +81,361 @@ class Plugin(indigo.PluginBase):
     # Start, Stop, Plugin Prefs
     #-------------------------------------------------------------------------------
     def startup(self):
+        phaseTimes = [('start', time.perf_counter())]
+
         self.logMissing  = self.pluginPrefs.get("logMissing", False)
         self.actionSleep = float(self.pluginPrefs.get("actionSleep",0))
+        self.saveDelay   = float(self.pluginPrefs.get("saveDelay",2.0))
+        self.useJournal  = self.pluginPrefs.get("useJournal",False)
+        self.asyncActions = self.pluginPrefs.get("asyncActions",False)
+        self.warmUp      = self.pluginPrefs.get("warmUp",True)
+        self.logSummary  = self.pluginPrefs.get("logSummary",False)
+        self.variableRate    = float(self.pluginPrefs.get("variableRate",0))
+        self.parallelActions = self.pluginPrefs.get("parallelActions",False)
+        self.parallelLimit   = int(self.pluginPrefs.get("parallelLimit",4))
+        self.exportMetrics   = self.pluginPrefs.get("exportMetrics",False)
+        self.metricsInterval = float(self.pluginPrefs.get("metricsInterval",60))
+        self.metricsDue  = time.time() + self.metricsInterval
         self.debug       = self.pluginPrefs.get("showDebugInfo",False)
         if self.debug:
             self.logger.debug('Debug logging enabled')
         self.debug = self.pluginPrefs.get("showDebugInfo",False)
 
-        lastStateDict  = self.pluginPrefs.get('lastStateDict',dict())
-        priorStateDict = self.pluginPrefs.get('priorStateDict',dict())
-        contextDict    = self.pluginPrefs.get('contextDict',dict())
-        groupsDict     = self.pluginPrefs.get('groupsDict',dict())
-        self.treeDict  = {namespace:StateTree(self,
-                                              namespace  = namespace,
-                                              lastState  = lastStateDict.get(namespace,''),
-                                              priorState = priorStateDict.get(namespace,''),
-                                              contexts   = list(contextDict.get(namespace,[])),
-                                              groups     = json.loads(groupsDict.get(namespace,'{}'))
-                                              ) for namespace in lastStateDict}
+        # name -> id index of existing action groups, kept current by subscription
+        self.actionGroupIndex = dict()
+        for group in indigo.actionGroups.iter():
+            self.actionGroupIndex.setdefault(group.name, group.id)
+        self.missingCount = 0
+        indigo.actionGroups.subscribeToChanges()
+        phaseTimes.append(('action groups', time.perf_counter()))
+
+        # one timer thread for every delayed change in every namespace
+        self.scheduler = TimerScheduler(self.logger)
+
+        # shared pool for action groups that may run concurrently within a phase
+        self.phaseIds = count(1)
+        self.hookPool = None
+        self._setHookPool()
+
+        # variable renames, moves and deletes invalidate cached leaves
+        indigo.variables.subscribeToChanges()
+
+        # last known value of each variable, so unchanged writes are skipped
+        self.shadow = dict()
+        self.writeCount = 0
+        self.unchangedCount = 0
+        self.mergedCount = 0
+
+        # variable writes from every namespace, merged by variable and paced
+        self.writer = VariableWriter(self)
+        self.writer.setRate(self.variableRate)
+
+        # persisted namespace states, updated only for dirty trees
+        self.saveLock    = threading.Lock()
+        self.saveDue     = None
+        self.savedStates = {key:dict(self.pluginPrefs.get(key,dict())) for key in
+                            ('lastStateDict','priorStateDict','contextDict','groupsDict','optionsDict','timersDict')}
+
+        lastStateDict  = self.savedStates['lastStateDict']
+        priorStateDict = self.savedStates['priorStateDict']
+        contextDict    = self.savedStates['contextDict']
+        groupsDict     = self.savedStates['groupsDict']
+        optionsDict    = self.savedStates['optionsDict']
+        timersDict     = self.savedStates['timersDict']
+        states = {namespace:dict(lastState  = lastStateDict.get(namespace,''),
+                                 priorState = priorStateDict.get(namespace,''),
+                                 contexts   = list(contextDict.get(namespace,[])),
+                                 groups     = json.loads(groupsDict.get(namespace,'{}')),
+                                 options    = json.loads(optionsDict.get(namespace,'{}')),
+                                 timers     = json.loads(timersDict.get(namespace,'{}'))
+                                 ) for namespace in lastStateDict}
+
+        # journal replaces pluginPrefs as the durable record of namespace states
+        self.journal = None
+        if self.useJournal:
+            self.journal = StateJournal(self._dataFolder(), self._namespaceStates)
+            states = self.journal.load(states)
+        phaseTimes.append(('saved states', time.perf_counter()))
+
+        # trees hold only saved data until first used
+        self.treeDict  = {namespace:StateTree(self, namespace, **state) for namespace, state in states.items()}
+
+        if self.journal:
+            self.journal.compact()
+            for tree in self.treeDict.values():
+                tree.dirty = True
+
+        phaseTimes.append(('namespaces', time.perf_counter()))
+
+        self._indexVariables()
+        self._indexBoundVariables()
+        phaseTimes.append(('variables', time.perf_counter()))
+
+        # action props -> config validation result, least recently used dropped first
+        self.validCache = OrderedDict()
+        self.validLock  = threading.Lock()
+
+        if self.warmUp:
+            threading.Thread(target=self._warmUpTrees, name='StateTree warm-up', daemon=True).start()
+
+        # timers saved at shutdown resume, or fire now if already due
+        for tree in self.treeDict.values():
+            tree.startTimers()
+
+        self.logger.info('startup: ' + ', '.join(f'{name} {(end-start)*1000:.0f} ms'
+            for (_, start), (name, end) in zip(phaseTimes, phaseTimes[1:]))
+            + f', total {(phaseTimes[-1][1]-phaseTimes[0][1])*1000:.0f} ms ({len(self.treeDict)} namespaces)')
+
+    #-------------------------------------------------------------------------------
+    def _warmUpTrees(self):
+        startTime = time.perf_counter()
+        for tree in list(self.treeDict.values()):
+            tree._ensureReady()
+        self.logger.debug(f'namespace warm-up {(time.perf_counter()-startTime)*1000:.0f} ms')
 
     #-------------------------------------------------------------------------------
     def shutdown(self):
+        self.scheduler.stop()
+        self._stopExecution(self.treeDict.values(), hurry=True)
+        self.writer.stop()
+        if self.hookPool:
+            self.hookPool.shutdown()
+        self.saveNamespaceStates()
         self.savePluginPrefs()
+        if self.exportMetrics:
+            self.saveMetrics()
+        if self.journal:
+            self.journal.close()
+
+    #-------------------------------------------------------------------------------
+    def _stopExecution(self, trees, timeout=10.0, hurry=False):
+        # signal every namespace worker before waiting, so they drain together
+        executors = list()
+        for tree in trees:
+            if tree.executor:
+                executors.append(tree.executor)
+                tree.executor = None
+        for executor in executors:
+            executor.signal(hurry)
+        deadline = time.time() + timeout
+        for executor in executors:
+            executor.join(max(0.0, deadline - time.time()))
+
+    #-------------------------------------------------------------------------------
+    def runConcurrentThread(self):
+        try:
+            while True:
+                if self.saveDue and time.time() >= self.saveDue:
+                    self.saveNamespaceStates()
+                if self.exportMetrics and time.time() >= self.metricsDue:
+                    self.metricsDue = time.time() + self.metricsInterval
+                    self.saveMetrics()
+                if self.journal and self.journal.compactDue:
+                    self.journal.compact()
+                self.sleep(0.25)
+        except self.StopThread:
+            pass
 
     #-------------------------------------------------------------------------------
     def savePluginPrefs(self):
         self.pluginPrefs['showDebugInfo']   = self.debug
         self.pluginPrefs['logMissing']      = self.logMissing
         self.pluginPrefs['actionSleep']     = self.actionSleep
+        self.pluginPrefs['saveDelay']       = self.saveDelay
+        self.pluginPrefs['useJournal']      = self.useJournal
+        self.pluginPrefs['asyncActions']    = self.asyncActions
+        self.pluginPrefs['warmUp']          = self.warmUp
+        self.pluginPrefs['logSummary']      = self.logSummary
+        self.pluginPrefs['variableRate']    = self.variableRate
+        self.pluginPrefs['parallelActions'] = self.parallelActions
+        self.pluginPrefs['parallelLimit']   = self.parallelLimit
+        self.pluginPrefs['exportMetrics']   = self.exportMetrics
+        self.pluginPrefs['metricsInterval'] = self.metricsInterval
 
         indigo.server.savePluginPrefs()
 
+    #-------------------------------------------------------------------------------
+    def requestSave(self, tree=None, fields=()):
+        # journal records only what changed; pluginPrefs catch up at shutdown
+        if tree and self.treeDict.get(tree.name) is not tree:
+            return      # namespace was removed
+        if self.journal:
+            if tree:
+                state = tree.state
+                self.journal.append(tree.name, {key:state[key] for key in (fields or state)})
+            return
+        # coalesce saves within the save delay window
+        if self.saveDelay <= 0:
+            self.saveNamespaceStates()
+        elif self.saveDue is None:
+            self.saveDue = time.time() + self.saveDelay
+
     #-------------------------------------------------------------------------------
     def saveNamespaceStates(self):
-        self.pluginPrefs['lastStateDict']  = {name:tree.lastState  for name,tree in self.treeDict.items()}
-        self.pluginPrefs['priorStateDict'] = {name:tree.priorState for name,tree in self.treeDict.items()}
-        self.pluginPrefs['contextDict']    = {name:tree.contexts   for name,tree in self.treeDict.items()}
-        self.pluginPrefs['groupsDict']     = {name:json.dumps(tree.groups)     for name,tree in self.treeDict.items()}
+        with self.saveLock:
+            self.saveDue = None
+            for name, tree in list(self.treeDict.items()):
+                if tree.dirty:
+                    tree.dirty = False
+                    self.savedStates['lastStateDict'][name]  = tree.lastState
+                    self.savedStates['priorStateDict'][name] = tree.priorState
+                    self.savedStates['contextDict'][name]    = list(tree.contexts)
+                    self.savedStates['groupsDict'][name]     = json.dumps(tree.groups)
+                    self.savedStates['optionsDict'][name]    = json.dumps(tree.options)
+                    self.savedStates['timersDict'][name]     = json.dumps(tree.timers)
+            for key, value in self.savedStates.items():
+                self.pluginPrefs[key] = value
+
+            indigo.server.savePluginPrefs()
 
-        indigo.server.savePluginPrefs()
+    #-------------------------------------------------------------------------------
+    def forgetNamespaceState(self, namespace):
+        with self.saveLock:
+            for value in self.savedStates.values():
+                value.pop(namespace, None)
+        if self.journal:
+            self.journal.append(namespace, None)
+        self.requestSave()
+
+    #-------------------------------------------------------------------------------
+    def _namespaceStates(self):
+        return {name:tree.state for name, tree in list(self.treeDict.items())}
+
+    #-------------------------------------------------------------------------------
+    def _dataFolder(self):
+        return os.path.join(indigo.server.getInstallFolderPath(), 'Preferences', 'Plugins', self.pluginId)
+
+    #-------------------------------------------------------------------------------
+    def saveMetrics(self):
+        # replace the metrics file atomically so readers never see a partial write
+        try:
+            folder = self._dataFolder()
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, kMetricsFile)
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'time'           : time.time(),
+                           'missingSkipped' : self.missingCount,
+                           'written'        : self.writeCount,
+                           'unchanged'      : self.unchangedCount,
+                           'merged'         : self.mergedCount,
+                           'namespaces'     : {name:tree.metrics.export() for name, tree in list(self.treeDict.items())},
+                           }, f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            self.logger.error(f'unable to export metrics \n{e}')
+
+    #-------------------------------------------------------------------------------
+    def _setHookPool(self):
+        # a replaced pool is left to finish any phase in flight and then collected
+        if self.parallelActions and self.parallelLimit > 1:
+            if not self.hookPool or self.hookPool._max_workers != self.parallelLimit:
+                self.hookPool = ThreadPoolExecutor(self.parallelLimit, thread_name_prefix='StateTree hook')
+        else:
+            self.hookPool = None
+
+    #-------------------------------------------------------------------------------
+    def _setJournal(self, useJournal):
+        if useJournal and not self.journal:
+            self.journal = StateJournal(self._dataFolder(), self._namespaceStates)
+            self.journal.compact()
+        elif self.journal and not useJournal:
+            self.journal.close()
+            self.journal = None
+            for tree in self.treeDict.values():
+                tree.dirty = True
+            self.saveNamespaceStates()
+        self.useJournal = useJournal
+
+    #-------------------------------------------------------------------------------
+    # Action Group Index
+    #-------------------------------------------------------------------------------
+    def actionGroupCreated(self, group):
+        self.actionGroupIndex.setdefault(group.name, group.id)
+        self._clearPlans()
+
+    #-------------------------------------------------------------------------------
+    def actionGroupUpdated(self, origGroup, newGroup):
+        if origGroup.name != newGroup.name:
+            self._unindexActionGroup(origGroup)
+            self.actionGroupIndex.setdefault(newGroup.name, newGroup.id)
+            self._clearPlans()
+
+    #-------------------------------------------------------------------------------
+    def actionGroupDeleted(self, group):
+        self._unindexActionGroup(group)
+        self._clearPlans()
+
+    #-------------------------------------------------------------------------------
+    def _unindexActionGroup(self, group):
+        if self.actionGroupIndex.get(group.name) == group.id:
+            del self.actionGroupIndex[group.name]
+            # another action group may share the name
+            for other in indigo.actionGroups.iter():
+                if other.name == group.name and other.id != group.id:
+                    self.actionGroupIndex[other.name] = other.id
+                    break
+
+    #-------------------------------------------------------------------------------
+    def _clearPlans(self):
+        for tree in self.treeDict.values():
+            tree._clearPlans()
+
+    #-------------------------------------------------------------------------------
+    # Variable Subscriptions
+    #-------------------------------------------------------------------------------
+    def variableCreated(self, var):
+        self.folderVars.setdefault(var.folderId, dict())[var.id] = var.name
+
+    #-------------------------------------------------------------------------------
+    def variableUpdated(self, origVar, newVar):
+        if newVar.value != origVar.value:
+            for tree in self.boundVars.get(newVar.id, ()):
+                self._boundVariableChanged(tree, newVar)
+        if newVar.id in self.shadow:
+            self.shadow[newVar.id] = newVar.value
+        if origVar.name != newVar.name or origVar.folderId != newVar.folderId:
+            self.folderVars.get(origVar.folderId, dict()).pop(origVar.id, None)
+            self.folderVars.setdefault(newVar.folderId, dict())[newVar.id] = newVar.name
+            self._forgetVariable(newVar.id)
+
+    #-------------------------------------------------------------------------------
+    def variableDeleted(self, var):
+        self.shadow.pop(var.id, None)
+        self.writer.discard(var.id)
+        self.folderVars.get(var.folderId, dict()).pop(var.id, None)
+        self._forgetVariable(var.id)
+
+    #-------------------------------------------------------------------------------
+    def _boundVariableChanged(self, tree, var):
+        if var.value == "":
+            self.logger.error(f'>>> "{tree.name}" source variable "{var.name}" is empty')
+        elif kStateReservedRe.search(var.value):
+            self.logger.error(f'>>> "{tree.name}" source variable "{var.name}" may not contain:  '+'  '.join(kStateReserved))
+        else:
+            tree.stateChange(var.value)
+
+    #-------------------------------------------------------------------------------
+    def _indexBoundVariables(self):
+        # source variable id -> namespaces it drives
+        boundVars = dict()
+        for tree in self.treeDict.values():
+            if tree.options['sourceVarId']:
+                boundVars.setdefault(tree.options['sourceVarId'], list()).append(tree)
+        self.boundVars = boundVars
+
+    #-------------------------------------------------------------------------------
+    def _indexVariables(self):
+        # one pass over all variables: ids and names by folder, and current values
+        folderVars = dict()
+        for var in indigo.variables.iter():
+            folderVars.setdefault(var.folderId, dict())[var.id] = var.name
+            self.shadow[var.id] = var.value
+        self.folderVars = folderVars
+
+    #-------------------------------------------------------------------------------
+    def _forgetVariable(self, varId):
+        for tree in self.treeDict.values():
+            tree._forgetVar(varId)
 
     #-------------------------------------------------------------------------------
     # Config and Validate
@@ -95,6 +445,19 @@ class Plugin(indigo.PluginBase):
             self.debug = valuesDict.get('showDebugInfo',False)
             self.logMissing = valuesDict.get('logMissing',False)
             self.actionSleep = float(valuesDict.get('actionSleep',0))
+            self.saveDelay = float(valuesDict.get('saveDelay',2.0))
+            self._setJournal(valuesDict.get('useJournal',False))
+            self.asyncActions = valuesDict.get('asyncActions',False)
+            self.warmUp = valuesDict.get('warmUp',True)
+            self.logSummary = valuesDict.get('logSummary',False)
+            self.variableRate = float(valuesDict.get('variableRate',0))
+            self.writer.setRate(self.variableRate)
+            self.parallelActions = valuesDict.get('parallelActions',False)
+            self.parallelLimit = int(valuesDict.get('parallelLimit',4))
+            self._setHookPool()
+            self.exportMetrics = valuesDict.get('exportMetrics',False)
+            self.metricsInterval = float(valuesDict.get('metricsInterval',60))
+            self.metricsDue = time.time() + self.metricsInterval
 
             self.logger.debug(f"Debug logging {['disabled','enabled'][self.debug]}")
 
@@ -109,12 +472,40 @@ class Plugin(indigo.PluginBase):
         except:
             errorsDict['actionSleep'] = "Must be a number between 0.0 and 5.0"
 
+        try:
+            n = float(valuesDict.get('saveDelay',2.0))
+            if not ( 0.0 <= n <= 10.0 ):
+                raise ValueError("saveDelay out of range")
+        except:
+            errorsDict['saveDelay'] = "Must be a number between 0.0 and 10.0"
+
+        try:
+            n = float(valuesDict.get('variableRate',0))
+            if not ( 0 <= n <= 100 ):
+                raise ValueError("variableRate out of range")
+        except:
+            errorsDict['variableRate'] = "Must be a number between 0 and 100"
+
+        try:
+            n = int(valuesDict.get('parallelLimit',4))
+            if not ( 1 <= n <= 16 ):
+                raise ValueError("parallelLimit out of range")
+        except:
+            errorsDict['parallelLimit'] = "Must be a whole number between 1 and 16"
+
+        try:
+            n = float(valuesDict.get('metricsInterval',60))
+            if not ( 10 <= n <= 3600 ):
+                raise ValueError("metricsInterval out of range")
+        except:
+            errorsDict['metricsInterval'] = "Must be a number between 10 and 3600"
+
         if len(errorsDict) > 0:
             return (False, valuesDict, errorsDict)
         return (True, valuesDict)
 
     #-------------------------------------------------------------------------------
-    def validateActionConfigUi(self, valuesDict, typeId, devId, runtime=False):
+    def validateActionConfigUi(self, valuesDict, typeId, devId):
         errorsDict = indigo.Dict()
 
         baseName = valuesDict.get('baseName',"")
@@ -129,75 +520,299 @@ class Plugin(indigo.PluginBase):
             stateName = valuesDict.get('stateName',"")
             if stateName == "":
                 errorsDict['stateName'] = "State Name must be at least one character long"
-            elif any(ch in stateName for ch in kStateReserved):
+            elif kStateReservedRe.search(stateName):
                 errorsDict['stateName'] = "State Name may not contain:  "+"  ".join(kStateReserved)
             valuesDict['description'] = f"{['','force '][force]}enter '{baseName}' state '{stateName}'"
 
-        elif typeId in ('addContext','removeContext'):
+        elif typeId in ('addContext','removeContext','toggleContext'):
             contextName = valuesDict.get('contextName',"")
             if contextName == "":
                 errorsDict['contextName'] = "Context must be at least one character long"
-            elif any(ch in contextName for ch in kBaseReserved):
+            elif kBaseReservedRe.search(contextName):
                 errorsDict['contextName'] = "Context may not contain:  "+"  ".join(kBaseReserved)
-            valuesDict['description'] = f"{['','force '][force]}{['add','remove'][typeId=='removeContext']} '{baseName}' context '{contextName}'"
+            if typeId == 'toggleContext':
+                valuesDict['description'] = f"toggle '{baseName}' context '{contextName}'"
+            else:
+                valuesDict['description'] = f"{['','force '][force]}{['add','remove'][typeId=='removeContext']} '{baseName}' context '{contextName}'"
 
         elif typeId == 'revertToPriorState':
-            var = self.treeDict[baseName].priorVar
-            if runtime:
-                if var.value == "":
-                    errorsDict['stateVarId'] = "State Name must be at least one character long"
-                elif any(ch in var.value for ch in kStateReserved):
-                    errorsDict['stateVarId'] = "State Name may not contain:  "+"  ".join(kStateReserved)
             valuesDict['description'] = f"revert '{baseName}' to prior state"
 
         elif typeId == 'variableToState':
             varId = valuesDict.get('stateVarId',"")
+            varName = ""
             if varId == "":
                 errorsDict['stateVarId'] = "No variable defined"
             else:
-                var = indigo.variables[int(varId)]
-            if runtime:
-                if var.value == "":
-                    errorsDict['stateVarId'] = "State Name must be at least one character long"
-                elif any(ch in var.value for ch in kStateReserved):
-                    errorsDict['stateVarId'] = "State Name may not contain:  "+"  ".join(kStateReserved)
-            valuesDict['description'] = f"{['','force '][force]}enter '{baseName}' state from variable '{var.name}'"
+                varName = indigo.variables[int(varId)].name
+            valuesDict['description'] = f"{['','force '][force]}enter '{baseName}' state from variable '{varName}'"
+
+        for key, text in (('delay',"after {} min"),('timeout',"for {} min")):
+            try:
+                n = float(valuesDict.get(key,"") or 0)
+                if n < 0:
+                    raise ValueError(f"{key} out of range")
+            except ValueError:
+                errorsDict[key] = "Must be a number of minutes, 0 or more"
+            else:
+                if n and 'description' in valuesDict:
+                    valuesDict['description'] += " " + text.format(f"{n:g}")
 
         if len(errorsDict) > 0:
             return (False, valuesDict, errorsDict)
         return (True, valuesDict)
 
     #-------------------------------------------------------------------------------
-    def _validateRuntime(self, action, typeId):
-        valid = self.validateActionConfigUi(action.props, typeId, action.deviceId, runtime=True)
-        if not valid[0]:
-            self.logger.error('Action "{typeId}" failed validation')
-            for key in valid[2]:
-                self.logger.error(f'{key}: {valid[2][key]}')
-        return valid[0]
+    def _validateRuntime(self, action, typeId, stateName=None):
+        errorsDict = self._validateProps(action.props, typeId, action.deviceId, stateName)
+        if errorsDict:
+            self.logger.error(f'Action "{typeId}" failed validation')
+            for key in errorsDict:
+                self.logger.error(f'{key}: {errorsDict[key]}')
+        return not errorsDict
+
+    #-------------------------------------------------------------------------------
+    def _validateProps(self, props, typeId, devId=0, stateName=None):
+        # props rarely change, so config validation is cached; only a state
+        # name read at runtime is checked every time
+        key = (typeId, tuple(sorted((k, str(v)) for k, v in props.items())))
+        with self.validLock:
+            valid = self.validCache.get(key)
+            if valid is not None:
+                self.validCache.move_to_end(key)
+        if valid is None:
+            valid = self.validateActionConfigUi(indigo.Dict(props), typeId, devId)
+            with self.validLock:
+                self.validCache[key] = valid
+                if len(self.validCache) > kValidCacheSize:
+                    self.validCache.popitem(last=False)
+        errorsDict = dict(valid[2]) if not valid[0] else dict()
+        if not errorsDict and stateName is not None:
+            if stateName == "":
+                errorsDict = {'stateVarId':"State Name must be at least one character long"}
+            elif kStateReservedRe.search(stateName):
+                errorsDict = {'stateVarId':"State Name may not contain:  "+"  ".join(kStateReserved)}
+        return errorsDict
 
     #-------------------------------------------------------------------------------
     # Action Methods
     #-------------------------------------------------------------------------------
     def doStateTreeAction(self, action):
-        if self._validateRuntime(action, action.pluginTypeId):
+        stateName = None
+        if action.pluginTypeId == 'variableToState' and action.props.get('stateVarId',""):
+            stateName = indigo.variables[int(action.props['stateVarId'])].value
+        elif action.pluginTypeId == 'revertToPriorState' and action.props.get('baseName',"") in self.treeDict:
+            stateName = self.treeDict[action.props['baseName']].priorState
+
+        if self._validateRuntime(action, action.pluginTypeId, stateName):
             tree = self.treeDict[action.props['baseName']]
-            if action.pluginTypeId == 'enterNewState':
-                tree.stateChange(action.props['stateName'], action.props.get('force',False))
-            elif action.pluginTypeId == 'variableToState':
-                tree.stateChange(indigo.variables[int(action.props['stateVarId'])].value, action.props.get('force',False))
-            elif action.pluginTypeId == 'revertToPriorState':
-                tree.stateRevert()
-            elif action.pluginTypeId == 'addContext':
-                tree.contextChange(action.props['contextName'], True, action.props.get('force',False))
-            elif action.pluginTypeId == 'removeContext':
-                tree.contextChange(action.props['contextName'], False, action.props.get('force',False))
-            elif action.pluginTypeId == 'toggleContext':
-                tree.contextToggle(action.props['contextName'])
-            else:
+            operation = self._operation(action.pluginTypeId, action.props, stateName)
+            if operation is None:
                 self.logger.error(f'Action not recognized: {action.pluginTypeId}')
+                return
+            delay   = float(action.props.get('delay',"") or 0) * 60
+            timeout = float(action.props.get('timeout',"") or 0) * 60
+            if delay:
+                tree.delayOperation(operation, delay, timeout)
+            else:
+                tree.runOperation(operation, timeout)
+
+    #-------------------------------------------------------------------------------
+    def _operation(self, typeId, props, stateName=None):
+        force = props.get('force',False)
+        if typeId == 'enterNewState':
+            return ['state', props['stateName'], force]
+        elif typeId == 'variableToState':
+            return ['state', stateName, force]
+        elif typeId == 'revertToPriorState':
+            return ['revert']
+        elif typeId == 'addContext':
+            return ['context', props['contextName'], True, force]
+        elif typeId == 'removeContext':
+            return ['context', props['contextName'], False, force]
+        elif typeId == 'toggleContext':
+            return ['toggle', props['contextName']]
+
+    #-------------------------------------------------------------------------------
+    def doBatchTransaction(self, action):
+        operations = action.props.get('operations', [])
+        if isinstance(operations, str):
+            try:
+                operations = json.loads(operations)
+            except ValueError as e:
+                self.logger.error(f'batch transaction: operations are not valid JSON \n{e}')
+                return indigo.Dict(success=False, results=indigo.List())
+        return self.runTransaction(operations)
+
+    #-------------------------------------------------------------------------------
+    def runTransaction(self, operations):
+        # plan every operation, execute all action groups in operation order,
+        # then write variables and save namespace states once
+        startTime = time.perf_counter()
+        results = list()
+        planned = list()
+        for index, operation in enumerate(operations):
+            operation = dict(operation)
+            typeId = operation.pop('action', "")
+            baseName = operation.get('baseName', "")
+            result = {'index':index, 'baseName':baseName, 'action':typeId, 'status':'failed', 'errors':dict()}
+            results.append(result)
+            stateName = None
+            if typeId == 'variableToState' and operation.get('stateVarId',""):
+                try:
+                    stateName = indigo.variables[int(operation['stateVarId'])].value
+                except (KeyError, ValueError):
+                    result['errors'] = {'stateVarId':"No such variable"}
+                    continue
+            if typeId not in kBatchActions:
+                result['errors'] = {'action':f"Action not recognized: {typeId}"}
+            else:
+                result['errors'] = self._validateProps(operation, typeId, 0, stateName)
+            if not result['errors']:
+                planned.append((result, typeId, operation, stateName))
+
+        trees = list()
+        for result, typeId, operation, stateName in planned:
+            tree = self.treeDict[operation['baseName']]
+            if tree not in trees:
+                trees.append(tree)
+
+        # lock in name order so concurrent transactions cannot deadlock
+        jobs = list()
+        locked = sorted(trees, key=lambda tree: tree.name)
+        for tree in locked:
+            tree._ensureReady()
+            tree.lock.acquire()
+        try:
+            # let queued jobs finish first, or the batch would run out of order with them
+            deadline = time.time() + 10.0
+            busy = [tree.name for tree in trees if tree.executor and not tree.executor.waitIdle(max(0.0, deadline - time.time()))]
+            if busy:
+                for result, typeId, operation, stateName in planned:
+                    result['errors'] = {'baseName':f"Queued actions still running for {', '.join(busy)}"}
+                planned = list()
+            for tree in trees:
+                tree.batch = jobs
+            for result, typeId, operation, stateName in planned:
+                tree = self.treeDict[operation['baseName']]
+                try:
+                    self._runBatchOperation(tree, result, typeId, operation, stateName)
+                except Exception as e:
+                    # drop whatever the failed operation had queued
+                    tree.actionList, tree.variableDict, tree.missingList = list(), dict(), list()
+                    result['status'] = 'failed'
+                    result['errors'] = {'action':f"{typeId} error: {e!r}"}
+
+            for tree, job in jobs:
+                tree._executeActions(job.actions, tree.sleep)
+            variables = dict()
+            for tree, job in jobs:
+                variables.setdefault(tree, dict()).update(job.variables)
+            written = sum(tree._changeVariables(treeVariables) for tree, treeVariables in variables.items())
+            self.writer.flush()     # callers may read the variables as soon as this returns
+        finally:
+            for tree in trees:
+                tree.batch = None
+            for tree in locked:
+                tree.lock.release()
+
+        # one save for the whole transaction
+        if busy:
+            pass
+        elif self.journal:
+            for tree in trees:
+                state = tree.state
+                self.journal.append(tree.name, state)
+        elif trees:
             self.saveNamespaceStates()
 
+        self.logger.info(f'batch transaction: {sum(result["status"] != "failed" for result in results)} of {len(results)} operations, '
+                         f'{sum(len(job.actions) for tree, job in jobs)} action groups, {written} variables, '
+                         f'{(time.perf_counter()-startTime)*1000:.0f} ms')
+        for result in results:
+            if result['errors']:
+                self.logger.error(f'batch operation {result["index"]} "{result["action"]}" failed: '
+                                  + ', '.join(f'{key}: {value}' for key, value in result['errors'].items()))
+
+        return indigo.Dict(success=all(result['status'] != 'failed' for result in results),
+                           results=indigo.List([indigo.Dict(result) for result in results]))
+
+    #-------------------------------------------------------------------------------
+    def _runBatchOperation(self, tree, result, typeId, operation, stateName):
+        force = operation.get('force', False)
+        delay   = float(operation.get('delay',"") or 0) * 60
+        timeout = float(operation.get('timeout',"") or 0) * 60
+        if delay:
+            # set while the tree is locked and saved with the rest of the batch
+            tree.delayOperation(self._operation(typeId, operation, stateName), delay, timeout)
+            result['status'] = 'scheduled'
+            result['state'] = tree.lastState
+            result['contexts'] = list(tree.contexts)
+            return
+        if typeId in ('enterNewState','variableToState','revertToPriorState'):
+            if typeId == 'enterNewState':
+                stateName = operation['stateName']
+            elif typeId == 'revertToPriorState':
+                # prior state may have changed earlier in the batch
+                stateName = tree.priorState
+                result['errors'] = self._validateProps(operation, typeId, 0, stateName)
+                if result['errors']:
+                    return
+            undo = tree._undoTimer(self._operation(typeId, operation, stateName)) if timeout else None
+            tree._cancelPending(kStateKey)
+            changed = tree._stateChange(stateName, force)
+        else:
+            undo = tree._undoTimer(self._operation(typeId, operation)) if timeout else None
+            context = operation['contextName']
+            tree._cancelPending(kContextChar+context)
+            enterExitBool = (context not in tree.contexts) if typeId == 'toggleContext' else (typeId == 'addContext')
+            changed = tree._contextChange(context, enterExitBool, force and typeId != 'toggleContext')
+        if undo:
+            tree._setTimer(*undo, timeout)
+        result['status'] = ['unchanged','changed'][bool(changed)]
+        result['state'] = tree.lastState
+        result['contexts'] = list(tree.contexts)
+
+    #-------------------------------------------------------------------------------
+    def doQuery(self, action):
+        # answered from memory, no indigo variables are read
+        props = action.props
+        typeId = action.pluginTypeId
+        if typeId == 'queryNamespaces':
+            names = props.get('baseNames') or list(self.treeDict)
+            if isinstance(names, str):
+                names = [name.strip() for name in names.split(',') if name.strip()]
+            missing = [name for name in names if name not in self.treeDict]
+            return indigo.Dict(success=not missing, missing=indigo.List(missing),
+                               namespaces=indigo.Dict({name:indigo.Dict(self.treeDict[name].snapshot())
+                                                      for name in names if name in self.treeDict}))
+
+        baseName = props.get('baseName',"")
+        tree = self.treeDict.get(baseName)
+        if tree is None:
+            self.logger.error(f'{typeId}: namespace "{baseName}" does not exist')
+            return indigo.Dict(success=False, error=f"Namespace '{baseName}' does not exist")
+
+        if typeId == 'queryState':
+            return indigo.Dict(success=True, **tree.snapshot())
+        elif typeId == 'queryInState':
+            return indigo.Dict(success=True, inState=tree.inState(props.get('stateName',"")))
+        elif typeId == 'queryContext':
+            return indigo.Dict(success=True, active=props.get('contextName',"") in tree.contexts)
+        elif typeId == 'queryContextGroup':
+            groupName = props.get('groupName',"")
+            if groupName not in tree.groups:
+                return indigo.Dict(success=False, error=f"Context group '{groupName}' does not exist")
+            members = list(tree.groups[groupName])
+            return indigo.Dict(success=True, members=indigo.List(members),
+                               active=indigo.List([context for context in members if context in tree.contexts]))
+        self.logger.error(f'Action not recognized: {typeId}')
+        return indigo.Dict(success=False, error=f"Action not recognized: {typeId}")
+
+    #-------------------------------------------------------------------------------
+    def flushVariables(self, action=None):
+        self.writer.flush()
+
     #-------------------------------------------------------------------------------
     # Menu Methods
     #-------------------------------------------------------------------------------
@@ -209,7 +824,7 @@ class Plugin(indigo.PluginBase):
                 errorText = "Base Name already exists"
             elif baseName == "":
                 errorText = "Required"
-            elif any(ch in baseName for ch in kBaseReserved):
+            elif kBaseReservedRe.search(baseName):
                 errorText = "Base Name may not contain:  "+"  ".join(kBaseReserved)
         elif typeId == 'removeNamespace':
             if baseName == "":
@@ -219,16 +834,47 @@ class Plugin(indigo.PluginBase):
         if errorText:
             return (False, valuesDict, indigo.Dict({'baseName':errorText}))
         else:
+            with self.validLock:
+                self.validCache.clear()
             if typeId == 'addNamespace':
                 self.treeDict[baseName] = StateTree(self, baseName)
-                self.saveNamespaceStates()
+                self.treeDict[baseName]._ensureReady()
+                self.treeDict[baseName]._setDirty()
                 self.logger.info(f'>>> namespace "{baseName}" added')
             elif typeId == 'removeNamespace':
-                del self.treeDict[baseName]
-                self.saveNamespaceStates()
+                tree = self.treeDict.pop(baseName)
+                tree.cancelTimers()
+                tree.cancelPending()
+                tree.stopExecution()
+                self.forgetNamespaceState(baseName)
+                self._indexBoundVariables()
                 self.logger.info(f'>>> namespace "{baseName}" removed')
             return (True, valuesDict)
 
+    #-------------------------------------------------------------------------------
+    def changeNamespaceOptions(self, valuesDict="", typeId=""):
+        baseName = valuesDict.get('baseName',"")
+        if baseName == "":
+            return (False, valuesDict, indigo.Dict({'baseName':"Required"}))
+        else:
+            errorsDict = indigo.Dict()
+            options = dict()
+            for key, default in kNamespaceOptions.items():
+                try:
+                    options[key] = type(default)(valuesDict.get(key,default))
+                    if options[key] < 0:
+                        raise ValueError(f"{key} out of range")
+                except (TypeError, ValueError):
+                    errorsDict[key] = "Must be a number 0 or greater"
+            if errorsDict:
+                return (False, valuesDict, errorsDict)
+            tree = self.treeDict[baseName]
+            tree.options = options
+            tree._setDirty('options')
+            self._indexBoundVariables()
+            self.logger.info(f'>>> options for "{baseName}" namespace changed')
+            return (True, valuesDict)
+
     #-------------------------------------------------------------------------------
     def changeContextGroup(self, valuesDict="", typeId=""):
         errorsDict = indigo.Dict()
@@ -252,7 +898,8 @@ class Plugin(indigo.PluginBase):
             elif typeId == 'removeContextGroup':
                 del tree.groups[groupName]
                 self.logger.info(f'>>> context group "{groupName}" removed from "{baseName}" namespace')
-            self.saveNamespaceStates()
+            tree.indexGroups()
+            tree._setDirty('groups')
             return (True, valuesDict)
 
     #-------------------------------------------------------------------------------
@@ -273,6 +920,15 @@ class Plugin(indigo.PluginBase):
             self.treeDict[valuesDict['baseName']].syncVariables()
         return (True, valuesDict)
 
+    #-------------------------------------------------------------------------------
+    def syncAllVariables(self):
+        self._indexVariables()     # also re-reads every current value
+        for name, tree in list(self.treeDict.items()):
+            try:
+                tree.syncVariables(refresh=False)
+            except Exception as e:
+                self.logger.error(f'{name}: variable sync error \n{e}')
+
     #-------------------------------------------------------------------------------
     def toggleDebug(self):
         if self.debug:
@@ -289,12 +945,71 @@ class Plugin(indigo.PluginBase):
         self.logger.info(f"Log missing action groups {['disabled','enabled'][self.logMissing]}")
         self.savePluginPrefs()
 
+    #-------------------------------------------------------------------------------
+    def logStatistics(self):
+        self.logger.info('State Tree statistics:')
+        self.logger.info(f'    action groups indexed         : {len(self.actionGroupIndex)}')
+        self.logger.info(f'    missing action groups skipped : {self.missingCount}')
+        self.logger.info(f'    variable values written       : {self.writeCount}')
+        self.logger.info(f'    unchanged variable writes     : {self.unchangedCount}')
+        self.logger.info(f'    merged variable writes        : {self.mergedCount}')
+        self.logger.info(f'    variable writes pending       : {len(self.writer.pending)}')
+        self.logger.info(f'    cached transition plans       : {sum(len(tree.plans) for tree in self.treeDict.values())}')
+        self.logger.info(f'    transition plan cache hits    : {sum(tree.planHits for tree in self.treeDict.values())}')
+        self.logger.info(f'    pending timers                : {sum(len(tree.timers) for tree in self.treeDict.values())}')
+        for name, tree in self.treeDict.items():
+            if tree.coalesced:
+                self.logger.info(f'    "{name}" coalesced transitions : {tree.coalesced}')
+
+    #-------------------------------------------------------------------------------
+    def logMetrics(self):
+        def row(label, histogram):
+            self.logger.info(f'    {label:<16}: {histogram.count:>6} {histogram.percentile(50)*1000:>9.1f} '
+                             f'{histogram.percentile(99)*1000:>9.1f} {histogram.max*1000:>9.1f} {histogram.mean*1000:>9.1f}')
+        self.logger.info('State Tree transition metrics (ms, percentiles are histogram bucket bounds):')
+        for name, tree in self.treeDict.items():
+            metrics = tree.metrics
+            self.logger.info(f'"{name}"              count       p50       p99       max      mean')
+            row('state changes',   metrics.stateChange)
+            row('context changes', metrics.contextChange)
+            row('lock wait',       metrics.lockWait)
+            row('job execution',   metrics.execute)
+            row('action groups',   metrics.hookTime)
+            self.logger.info(f'    {"groups skipped":<16}: {metrics.missing} missing, {metrics.deleted} deleted, '
+                             f'{metrics.slept:.1f} s between action groups')
+            for hook, (hookCount, total, longest) in metrics.slowestHooks(3):
+                self.logger.info(f'    {"slowest":<16}: {hook} x{hookCount}, mean {total/hookCount*1000:.1f} ms, max {longest*1000:.1f} ms')
+
+    #-------------------------------------------------------------------------------
+    def logFootprint(self):
+        self.logger.info('State Tree memory footprint (bytes):')
+        seen = set()
+        total = 0
+        for name, tree in self.treeDict.items():
+            sizes = tree.footprint(seen)
+            total += sum(sizes.values())
+            self.logger.info(f'    "{name}": {len(tree.leaves)} leaves, {len(tree.branches)} branches, {len(tree.plans)} plans, '
+                             + ', '.join(f'{key} {size}' for key, size in sizes.items()))
+        self.logger.info(f'    total: {total}')
+
     #-------------------------------------------------------------------------------
     # Menu Callbacks
     #-------------------------------------------------------------------------------
     def listNamespaces(self, filter="", valuesDict=None, typeId="", targetId=0):
         return [(namespace,namespace) for namespace in self.treeDict]
 
+    #-------------------------------------------------------------------------------
+    def loadNamespaceOptions(self, valuesDict=None, typeId='', targetId=0):
+        baseName = valuesDict.get('baseName',"")
+        if baseName in self.treeDict:
+            for key, value in self.treeDict[baseName].options.items():
+                valuesDict[key] = value if isinstance(value, bool) else str(value)
+        return valuesDict
+
+    #-------------------------------------------------------------------------------
+    def listSourceVariables(self, filter="", valuesDict=None, typeId="", targetId=0):
+        return [("0","- none -")] + [(str(var.id),var.name) for var in indigo.variables.iter()]
+
     #-------------------------------------------------------------------------------
     def updateContextGroup(self, valuesDict=None, typeId='', targetId=0):
         valuesDict['showGroupName'] = 'true'
@@ -315,28 +1030,69 @@ class Plugin(indigo.PluginBase):
 class StateTree(object):
 
     #-------------------------------------------------------------------------------
-    def __init__(self, plugin, namespace, lastState="", priorState="", contexts=list(), groups=dict()):
+    def __init__(self, plugin, namespace, lastState="", priorState="", contexts=list(), groups=dict(), options=dict(), timers=dict()):
         self.plugin      = plugin
         self.logger      = plugin.logger
         self.sleep       = plugin.sleep
 
-        self.lock        = threading.Lock()
+        self.lock        = threading.RLock()
 
-        self.name        = namespace
-        self.actionName  = namespace
+        self.name        = sys.intern(namespace)
+        self.actionName  = self.name
         self.lastState   = lastState
         self.priorState  = priorState
-        self.contexts    = contexts
+        self.contexts    = dict.fromkeys(map(sys.intern, contexts))     # ordered set
         self.groups      = groups
-        self.folder      = self._getFolder()
-        self.lastVar     = self._getVar(self.name)
-        self.priorVar    = self._getVar(self.name+kPriorSuffix,   double_underscores=True)
-        self.changedVar  = self._getVar(self.name+kChangedSuffix, double_underscores=True)
-        self.contextVar  = self._getVar(self.name+kContextSuffix, double_underscores=True)
+        self.options     = dict(kNamespaceOptions, **options)
+        self.timers      = {key:list(timer) for key, timer in timers.items()}   # key -> [due, armed, operation, timeout]
+        self.dirty       = False
+
+        # indigo folder, variables and branch are resolved on first use
+        self.ready       = False
+        self.folder      = None
+        self.branch      = None
+
+        # interned leaves by path and variable ids by name, so known states
+        # never touch the indigo variable database
+        self.leaves      = dict()
+        self.branches    = dict()
+        self.varIds      = dict()
+        self.varNames    = dict()
 
-        self.branch     = StateBranch(self, lastState)
         self.actionList = list()
         self.variableDict = dict()
+        self.missingList = list()       # missing action groups of the plan being built
+        self.executor   = None
+        self.batch      = None      # shared job list while in a batch transaction
+
+        # newest state request, so superseded requests waiting on the lock can be dropped
+        self.stateSerial = 0
+        self.coalesced   = 0
+
+        # changes held back by the debounce window or minimum dwell time
+        self.pendingLock = threading.Lock()
+        self.pending     = dict()
+        self.changeTimes = dict()
+
+        # planned action groups and leaf variables by transition signature
+        self.plans       = OrderedDict()
+        self.planHits    = 0
+
+        self.metrics     = TreeMetrics()
+
+        self.indexGroups()
+
+    #-------------------------------------------------------------------------------
+    def _ensureReady(self):
+        if not self.ready:
+            with self.lock:     # variable callbacks may forget ids while they are filled
+                if not self.ready:
+                    self.folder = self._getFolder()
+                    self._getVarId(self.name)
+                    for suffix in (kPriorSuffix, kChangedSuffix, kContextSuffix):
+                        self._getVarId(self.name+suffix, double_underscores=True)
+                    self.branch = self._getBranch(self.lastState)
+                    self.ready  = True
 
     #-------------------------------------------------------------------------------
     def stateRevert(self):
@@ -344,7 +1100,23 @@ class StateTree(object):
 
     #-------------------------------------------------------------------------------
     def stateChange(self, newState, force=False):
+        if force or not self._deferChange(kStateKey, newState):
+            self._stateChange(newState, force)
+
+    #-------------------------------------------------------------------------------
+    def _stateChange(self, newState, force=False):
+        startTime = time.perf_counter()
+        self._ensureReady()
+        self.stateSerial += 1
+        serial = self.stateSerial
+        waitTime = time.perf_counter()
         with self.lock:
+            self.metrics.lockWait.add(time.perf_counter() - waitTime)
+
+            if self.options['coalesce'] and serial != self.stateSerial:
+                self.coalesced += 1
+                self.logger.debug('>>> state "%s%s%s" superseded', self.name, kBaseChar, newState)
+                return
 
             if not newState:
                 self.logger.error(f'>>> no state defined "{self.name+kBaseChar+newState}"')
@@ -352,124 +1124,436 @@ class StateTree(object):
 
             elif newState == self.lastState:
                 if force:
-                    oldBranch = StateBranch(self,"")
+                    oldBranch = self._getBranch("")
                 else:
-                    self.logger.debug(f'>>> already in state "{self.name+kBaseChar+newState}"')
+                    self.logger.debug('>>> already in state "%s%s%s"', self.name, kBaseChar, newState)
                     return
 
             else:
                 oldBranch = self.branch
 
-            self.logger.info( f'>>> go to state "{self.name+kBaseChar+newState}"')
-            self.logger.debug(f'>>> from state  "{self.name+kBaseChar+self.lastState}"')
-
-            newBranch  = StateBranch(self, newState)
-
-            # global enter action group
-            self._setAction(kEnter)
-
-            # back out old branch until it matches new branch
-            leafnames = list(leaf.name for leaf in newBranch.leaves)
-            for i, leaf in reversed(list(enumerate(oldBranch.leaves))):
-                if leaf.name in leafnames:
-                    i += 1
-                    break
-                leaf._setAction(kExit)
-            else: i = 0   # if oldBranch is empty, i won't initialize
-
-            # enter new branch from matching point
-            for leaf in newBranch.leaves[i:]:
-                leaf._setAction(kEnter)
-
-            # global exit action group
-            self._setAction(kExit)
+            if not self.plugin.logSummary:
+                self.logger.info('>>> go to state "%s%s%s"', self.name, kBaseChar, newState)
+            self.logger.debug('>>> from state  "%s%s%s"', self.name, kBaseChar, self.lastState)
+
+            newBranch  = self._getBranch(newState)
+
+            # replace a state change still waiting in the queue with the net transition
+            fromBranch = oldBranch
+            priorState = self.lastState
+            if self.options['coalesce'] and self.executor:
+                pending = self.executor.takeStateJob()
+                if pending:
+                    self.coalesced += 1
+                    fromBranch = pending.fromBranch
+                    priorState = fromBranch.state     # the superseded state's actions never ran
+                    self.variableDict.update(pending.variables)
+                    # leaf variables end up matching the new branch
+                    for leaf in self.branch.leaves:
+                        self._queueVariable(leaf.varId, kExit)
+                    for leaf in newBranch.leaves:
+                        self._queueVariable(leaf.varId, kEnter)
+                    self.logger.debug('>>> coalesced from state "%s%s%s"', self.name, kBaseChar, fromBranch.state)
+
+            if force or fromBranch.state != newState:
+                self._planStateChange(fromBranch, newBranch)
 
             # save new state
             self.branch = newBranch
-            self.priorState = self.lastState
+            self.priorState = priorState
             self.lastState = newState
+            self.changeTimes[kStateKey] = time.time()
+            self._supersedeTimer(kStateKey, newState)
+            self._setDirty('lastState','priorState')
 
             # save new state and timestamp to variables
-            self._queueVariable(self.priorVar, self.priorState)
-            self._queueVariable(self.lastVar,  self.lastState)
-            self._queueVariable(self.changedVar, indigo.server.getTime())
+            self._queueVariable(self.priorVarId,   self.priorState)
+            self._queueVariable(self.lastVarId,    self.lastState)
+            self._queueVariable(self.changedVarId, indigo.server.getTime())
 
             # make the change
-            self._executeActions()
-            self._changeVariables()
+            summary = None
+            if self.plugin.logSummary:
+                summary = f'{self.name+kBaseChar+newState} (from "{self.priorState}")'
+            self._commit(fromBranch, summary)
+            self.metrics.stateChange.add(time.perf_counter() - startTime)
+            return True
+
+    #-------------------------------------------------------------------------------
+    def _planStateChange(self, oldBranch, newBranch):
+        key = (kStateKey, oldBranch.state, newBranch.state, tuple(self.contexts))
+        self._usePlan(key, self._buildStateChange, oldBranch, newBranch)
+
+    #-------------------------------------------------------------------------------
+    def _buildStateChange(self, oldBranch, newBranch):
+
+        # global enter action group
+        self._setAction(kEnter)
+
+        # back out old branch until it matches new branch
+        leafnames = list(leaf.name for leaf in newBranch.leaves)
+        for i, leaf in reversed(list(enumerate(oldBranch.leaves))):
+            if leaf.name in leafnames:
+                i += 1
+                break
+            leaf._setAction(kExit)
+        else: i = 0   # if oldBranch is empty, i won't initialize
+
+        # enter new branch from matching point
+        for leaf in newBranch.leaves[i:]:
+            leaf._setAction(kEnter)
+
+        # global exit action group
+        self._setAction(kExit)
 
     #-------------------------------------------------------------------------------
     def contextToggle(self, context):
-        self.contextChange(context, context not in self.contexts)
+        with self.pendingLock:
+            current = self.pending.get(kContextChar+context, context in self.contexts)
+        self.contextChange(context, not current)
 
     #-------------------------------------------------------------------------------
     def contextChange(self, context, enterExitBool, force=False):
+        if force or not self._deferChange(kContextChar+context, enterExitBool):
+            self._contextChange(context, enterExitBool, force)
+
+    #-------------------------------------------------------------------------------
+    def _contextChange(self, context, enterExitBool, force=False):
+        startTime = time.perf_counter()
+        self._ensureReady()
+        waitTime = time.perf_counter()
+        with self.lock:
+            self.metrics.lockWait.add(time.perf_counter() - waitTime)
 
-        if force or [(context in self.contexts),(context not in self.contexts)][enterExitBool]:
+            if force or [(context in self.contexts),(context not in self.contexts)][enterExitBool]:
 
-            # exit other contexts in shared context groups
-            if enterExitBool == kEnter:
-                for group in self.groups.values():
-                    if context in group:
-                        for item in group:
+                # exit other contexts in shared context groups, in the same batch
+                changes = list()
+                if enterExitBool == kEnter:
+                    for group in self.contextGroups.get(context, ()):
+                        for item in self.groups[group]:
                             if item != context:
-                                self.contextChange(item, kExit, force)
+                                changes.append(self._planContextChange(item, kExit, force))
 
-            self.logger.info(f'>>> {["remove","add"][enterExitBool]} context "{self.name+kContextChar+context}"')
-            with self.lock:
+                changes.append(self._planContextChange(context, enterExitBool, force))
 
-                # execute global add context action group
-                if enterExitBool == kEnter:
-                    self._setContext(context, kEnter)
-                    if context not in self.contexts:
-                        self.contexts.append(context)
+                # save changes
+                self._queueVariable(self.contextVarId, self._contextListString)
+                self._queueVariable(self.changedVarId, indigo.server.getTime())
+                self._setDirty('contexts')
+
+                summary = None
+                if self.plugin.logSummary:
+                    summary = self.name + ' ' + ' '.join(change for change in changes if change)
+                self._commit(None, summary)
+                self.metrics.contextChange.add(time.perf_counter() - startTime)
+                return True
 
-                # execute context action group for each nested state
-                incr = [-1,1][enterExitBool]
-                for leaf in self.branch.leaves[::incr]:
-                    leaf._setContext(context, enterExitBool)
+            else:
+                self.logger.debug('>>> context "%s%s%s" already %s', self.name, kContextChar, context, ["removed","added"][enterExitBool])
 
-                # execute global remove context action group
-                if enterExitBool == kExit:
-                    self._setContext(context, kExit)
-                    if context in self.contexts:
-                        self.contexts.remove(context)
+    #-------------------------------------------------------------------------------
+    def _planContextChange(self, context, enterExitBool, force):
+        if not (force or [(context in self.contexts),(context not in self.contexts)][enterExitBool]):
+            return None
 
-                # save changes
-                self._queueVariable(self._getVar(self.name + kContextExtra + context, double_underscores=True), enterExitBool)
-                self._queueVariable(self.contextVar, self._contextListString)
-                self._queueVariable(self.changedVar, indigo.server.getTime())
+        if not self.plugin.logSummary:
+            self.logger.info('>>> %s context "%s%s%s"', ["remove","add"][enterExitBool], self.name, kContextChar, context)
+
+        key = (kContextChar, self.branch.state, context, enterExitBool)
+        self._usePlan(key, self._buildContextChange, context, enterExitBool)
+
+        if enterExitBool == kEnter:
+            self.contexts[sys.intern(context)] = None
+        else:
+            self.contexts.pop(context, None)
+
+        self._queueVariable(self._contextVarId(context), enterExitBool)
+        self.changeTimes[kContextChar+context] = time.time()
+        self._supersedeTimer(kContextChar+context, enterExitBool)
+        return ['-','+'][enterExitBool] + context
+
+    #-------------------------------------------------------------------------------
+    def indexGroups(self):
+        # context -> names of the groups it belongs to
+        self.contextGroups = dict()
+        for group, items in self.groups.items():
+            for item in items:
+                self.contextGroups.setdefault(item, list()).append(group)
+        self._clearPlans()
+
+    #-------------------------------------------------------------------------------
+    def _buildContextChange(self, context, enterExitBool):
+
+        # execute global add context action group
+        if enterExitBool == kEnter:
+            self._setContext(context, kEnter)
+
+        # execute context action group for each nested state
+        incr = [-1,1][enterExitBool]
+        for leaf in self.branch.leaves[::incr]:
+            leaf._setContext(context, enterExitBool)
+
+        # execute global remove context action group
+        if enterExitBool == kExit:
+            self._setContext(context, kExit)
+
+    #-------------------------------------------------------------------------------
+    def _usePlan(self, key, build, *args):
+        # queue a cached plan, building it first if this transition is new
+        plans = self.plans
+        plan = plans.get(key)
+        if plan is None:
+            actionList, variableDict, missingList = self.actionList, self.variableDict, self.missingList
+            self.actionList, self.variableDict, self.missingList = list(), dict(), list()
+            build(*args)
+            plan = (tuple(self.actionList), tuple(self.variableDict.items()), tuple(self.missingList))
+            self.actionList, self.variableDict, self.missingList = actionList, variableDict, missingList
+            plans[key] = plan
+            if len(plans) > kPlanCacheSize:
+                plans.popitem(last=False)
+        else:
+            plans.move_to_end(key)
+            self.planHits += 1
+            # missing action groups are skipped at planning, report them on every use
+            for action in plan[2]:
+                self._missingAction(action)
+        self.actionList.extend(plan[0])
+        self.variableDict.update(plan[1])
+
+    #-------------------------------------------------------------------------------
+    def _clearPlans(self):
+        self.plans = OrderedDict()
+
+    #-------------------------------------------------------------------------------
+    def _deferChange(self, key, value):
+        # hold a change for the debounce window, or until the minimum dwell time has passed
+        debounce, dwell = self.options['debounce'], self.options['dwell']
+        if not (debounce or dwell):
+            return False
+        with self.pendingLock:
+            if key not in self.pending:
+                delay = max(debounce, self.changeTimes.get(key,0.0) + dwell - time.time())
+                if delay <= 0:
+                    return False
+                self.plugin.scheduler.schedule(delay, (self.name, key), self._applyPending, key)
+            self.pending[key] = value
+        self.logger.debug('>>> "%s" %s held: %s', self.name, key, value)
+        return True
+
+    #-------------------------------------------------------------------------------
+    def _applyPending(self, key):
+        # only the last value requested within the window is applied
+        if self.plugin.treeDict.get(self.name) is not self:
+            return      # namespace was removed
+        self._ensureReady()
+        with self.pendingLock:
+            if key not in self.pending:
+                return      # cancelled
+            value = self.pending.pop(key)
+        if key == kStateKey:
+            self._stateChange(value)
+        else:
+            context = key[len(kContextChar):]
+            if value == (context in self.contexts):
+                self.logger.debug('>>> context "%s%s%s" change cancelled out', self.name, kContextChar, context)
+                with self.lock:
+                    self._queueVariable(self._contextVarId(context), value)
+                    self._queueVariable(self.contextVarId, self._contextListString)
+                    self._commit()
+            else:
+                self._contextChange(context, value)
+
+    #-------------------------------------------------------------------------------
+    def cancelPending(self):
+        with self.pendingLock:
+            for key in self.pending:
+                self.plugin.scheduler.cancel((self.name, key))
+            self.pending.clear()
+
+    #-------------------------------------------------------------------------------
+    def _cancelPending(self, key):
+        with self.pendingLock:
+            if key in self.pending:
+                del self.pending[key]
+                self.plugin.scheduler.cancel((self.name, key))
+
+    #-------------------------------------------------------------------------------
+    # Queries
+    #-------------------------------------------------------------------------------
+    def inState(self, stateName):
+        # true for the current state and every state above it in the tree
+        lastState = self.lastState
+        return lastState == stateName or lastState.startswith(stateName+kStateChar)
+
+    #-------------------------------------------------------------------------------
+    def snapshot(self):
+        with self.lock:
+            names = self.lastState.split(kStateChar) if self.lastState else []
+            return dict(lastState  = self.lastState,
+                        priorState = self.priorState,
+                        branch     = [kStateChar.join(names[:i+1]) for i in range(len(names))],
+                        contexts   = list(self.contexts),
+                        groups     = {group:list(items) for group, items in self.groups.items()},
+                        timers     = len(self.timers))
 
-                self._executeActions()
-                self._changeVariables()
+    #-------------------------------------------------------------------------------
+    # Timers
+    #-------------------------------------------------------------------------------
+    def runOperation(self, operation, timeout=0.0):
+        undo = self._undoTimer(operation) if timeout else None
+        kind = operation[0]
+        if kind == 'state':
+            self.stateChange(operation[1], operation[2])
+        elif kind == 'revert':
+            self.stateRevert()
+        elif kind == 'context':
+            self.contextChange(operation[1], operation[2], operation[3])
+        elif kind == 'toggle':
+            self.contextToggle(operation[1])
+
+        if undo:
+            self._setTimer(*undo, timeout)
+
+    #-------------------------------------------------------------------------------
+    def _undoTimer(self, operation):
+        # taken before the operation runs: undo later, unless something else changes it first
+        with self.lock:
+            kind = operation[0]
+            if kind == 'state':
+                return kStateKey, operation[1], ['revert']
+            elif kind == 'revert':
+                return kStateKey, self.priorState, ['state', self.lastState, False]
+            elif kind == 'context':
+                return kContextChar+operation[1], operation[2], ['context', operation[1], not operation[2], False]
+            elif kind == 'toggle':
+                enterExitBool = operation[1] not in self.contexts
+                return kContextChar+operation[1], enterExitBool, ['context', operation[1], not enterExitBool, False]
 
+    #-------------------------------------------------------------------------------
+    def delayOperation(self, operation, delay, timeout=0.0):
+        # armed with the current value, so any change to it in the meantime cancels
+        if operation[0] in ('state','revert'):
+            self._setTimer(kStateKey, self.lastState, operation, delay, timeout)
         else:
-            self.logger.debug(f'>>> context "{self.name+kContextChar+context}" already {["removed","added"][enterExitBool]}')
+            self._setTimer(kContextChar+operation[1], operation[1] in self.contexts, operation, delay, timeout)
+
+    #-------------------------------------------------------------------------------
+    def startTimers(self):
+        for key in list(self.timers):
+            self._startTimer(key)
+
+    #-------------------------------------------------------------------------------
+    def cancelTimers(self):
+        with self.lock:
+            for key in self.timers:
+                self.plugin.scheduler.cancel((self.name, kTimerKey, key))
+            self.timers.clear()
 
     #-------------------------------------------------------------------------------
-    def syncVariables(self):
+    def _setTimer(self, key, armed, operation, delay, timeout=0.0):
+        # one timer per state or context; a new one replaces any pending
         with self.lock:
-            self.logger.debug(f'syncing variables for namespace "{self.name}"')
+            self.timers[key] = [time.time()+delay, armed, operation, timeout]
+            self._startTimer(key)
+            self._setDirty('timers')
+        self.logger.debug('>>> "%s" %s timer set: %s in %.0f s', self.name, key, operation, delay)
+
+    #-------------------------------------------------------------------------------
+    def _startTimer(self, key):
+        delay = max(0.0, self.timers[key][0] - time.time())
+        self.plugin.scheduler.schedule(delay, (self.name, kTimerKey, key), self._fireTimer, key)
+
+    #-------------------------------------------------------------------------------
+    def _supersedeTimer(self, key, value):
+        timer = self.timers.get(key)
+        if timer and timer[1] != value:
+            del self.timers[key]
+            self.plugin.scheduler.cancel((self.name, kTimerKey, key))
+            self._setDirty('timers')
+            self.logger.debug('>>> "%s" %s timer cancelled', self.name, key)
+
+    #-------------------------------------------------------------------------------
+    def _fireTimer(self, key):
+        with self.lock:
+            timer = self.timers.pop(key, None)
+            if timer is None:
+                return
+            self._setDirty('timers')
+            due, armed, operation, timeout = timer
+            current = self.lastState if key == kStateKey else (key[len(kContextChar):] in self.contexts)
+        if current != armed:
+            self.logger.debug('>>> "%s" %s timer superseded', self.name, key)
+            return
+        self.logger.info('>>> "%s" timer: %s', self.name, ' '.join(str(item) for item in operation))
+        self.runOperation(operation, timeout)
+
+    #-------------------------------------------------------------------------------
+    def syncVariables(self, refresh=True):
+        # re-read current values in one pass, so variables changed outside the plugin are repaired
+        if refresh:
+            self.plugin._indexVariables()
+        self._ensureReady()
+        with self.lock:
+            self.logger.debug('syncing variables for namespace "%s"', self.name)
 
             # all variables in namespace folder default to False
-            for var in indigo.variables.iter():
-                if var.folderId == self.folder:
-                    if var.id not in (self.lastVar.id, self.changedVar.id, self.contextVar.id):
-                        self._queueVariable(var, False)
+            skipIds = (self.lastVarId, self.changedVarId, self.contextVarId)
+            for varId, name in list(self.plugin.folderVars.get(self.folder, dict()).items()):
+                if varId not in skipIds:
+                    self.varNames.setdefault(varId, name)
+                    self._queueVariable(varId, False)
             # current leaves in state tree
             for leaf in self.branch.leaves:
-                self._queueVariable(leaf.var, True)
+                self._queueVariable(leaf.varId, True)
             #current contexts
             for context in self.contexts:
-                var = self._getVar(self.name + kContextExtra + context, double_underscores=True)
-                self._queueVariable(var, True)
+                self._queueVariable(self._contextVarId(context), True)
             # context list
-            self._queueVariable(self.contextVar, self._contextListString)
+            self._queueVariable(self.contextVarId, self._contextListString)
             # last leaf
-            self._queueVariable(self.lastVar, self.branch.leaves[-1].name)
+            if self.branch.leaves:
+                self._queueVariable(self.lastVarId, self.branch.leaves[-1].name)
 
             # update the variables
-            self._changeVariables()
+            self._commit()
+
+    #-------------------------------------------------------------------------------
+    def stopExecution(self):
+        if self.executor:
+            self.executor.stop()
+            self.executor = None
+
+    #-------------------------------------------------------------------------------
+    def _commit(self, fromBranch=None, summary=None):
+        # hand off queued actions and variables, inline or to the namespace worker
+        job = ActionJob(self.actionList, self.variableDict, fromBranch, summary)
+        self.actionList, self.variableDict, self.missingList = list(), dict(), list()
+        if self.batch is not None:
+            self.batch.append((self, job))
+        elif self.plugin.asyncActions:
+            if not self.executor:
+                self.executor = ActionQueue(self)
+            self.executor.submit(job)
+        else:
+            self._runJob(job, self.sleep)
+
+    #-------------------------------------------------------------------------------
+    def _runJob(self, job, sleep):
+        startTime = time.perf_counter()
+        self._executeActions(job.actions, sleep)
+        written = self._changeVariables(job.variables)
+        elapsed = time.perf_counter() - startTime
+        self.metrics.execute.add(elapsed)
+        if job.summary:
+            self.logger.info('%s: %d action groups, %d variables, %.0f ms',
+                job.summary, len(job.actions), written, elapsed*1000)
+
+    #-------------------------------------------------------------------------------
+    def _setDirty(self, *fields):
+        self.dirty = True
+        if self.batch is None:
+            self.plugin.requestSave(self, fields)
 
     #-------------------------------------------------------------------------------
     def _setAction(self, enterExitBool):
@@ -480,42 +1564,176 @@ class StateTree(object):
         self._queueAction(self.actionName+kContextChar+context+[kExitChar,''][enterExitBool])
 
     #-------------------------------------------------------------------------------
-    def _queueAction(self, action):
-        self.actionList.append(action)
+    def _queueAction(self, action, phase=0):
+        # only queue action groups that exist; adjacent actions sharing a
+        # non-zero phase do not depend on each other's order
+        actionId = self.plugin.actionGroupIndex.get(action)
+        if actionId is None:
+            self.missingList.append(action)
+            self._missingAction(action)
+        else:
+            self.actionList.append((action, actionId, phase))
 
     #-------------------------------------------------------------------------------
-    def _executeActions(self):
-        self.logger.debug('>>> action groups:')
-        pad = max([len(action) for action in self.actionList]) + 1
-        indent = ['    ',''][self.plugin.logMissing]
-        for action in self.actionList:
-            try:
-                indigo.actionGroup.execute(action)
-                self.logger.debug(f'{indent}{action:<{pad}}: executed')
-                self.sleep(self.plugin.actionSleep)
-            except Exception as e:
-                if isinstance(e, ValueError) and str(e).startswith('ElementNotFoundError'):
-                    if self.plugin.logMissing:
-                        self.logger.info(f'{action:<{pad}}: missing')
-                    else:
-                        self.logger.debug(f'{indent}{action:<{pad}}: missing')
-                else:
-                    self.logger.error(f'{self.name}: action group execute error \n{e}')
-        self.actionList = list()
+    def _missingAction(self, action):
+        self.plugin.missingCount += 1
+        self.metrics.missing += 1
+        if self.plugin.logMissing:
+            self.logger.info('%s: missing', action)
+        else:
+            self.logger.debug('    %s: missing', action)
 
     #-------------------------------------------------------------------------------
-    def _queueVariable(self, var, value):
-        self.variableDict[var.id] = (var, value)
+    def _executeActions(self, actions, sleep):
+        # padding is only worth computing when the debug lines will be shown
+        debug = self.plugin.debug
+        if debug:
+            self.logger.debug('>>> action groups:')
+            pad = max([len(item[0]) for item in actions] or [0]) + 1
+        metrics = self.metrics
+        pool = self.plugin.hookPool
+        for phase in (self._phases(actions) if pool else ([item] for item in actions)):
+            if len(phase) == 1:
+                results = [self._executeAction(phase[0][1])]
+            else:
+                # barrier: every action group in the phase finishes before the next phase
+                results = [future.result() for future in [pool.submit(self._executeAction, actionId) for action, actionId, group in phase]]
+            executed = False
+            for (action, actionId, group), (status, elapsed) in zip(phase, results):
+                if status == 'executed':
+                    executed = True
+                    metrics.addHook(action, elapsed)
+                elif status == 'deleted':
+                    metrics.deleted += 1
+                if debug and status != 'error':
+                    self.logger.debug('    %-*s: %s', pad, action, status)
+            if executed and self.plugin.actionSleep:
+                sleep(self.plugin.actionSleep)
+                metrics.slept += self.plugin.actionSleep
 
     #-------------------------------------------------------------------------------
-    def _changeVariables(self):
-        self.logger.debug('>>> variables:')
-        pad = max([len(var.name) for var,value in self.variableDict.values()]) + 1
-        for varId in self.variableDict:
-            var, value = self.variableDict[varId]
-            indigo.variable.updateValue(var.id, str(value))
-            self.logger.debug(f'    {var.name:<{pad}}: {value}')
-        self.variableDict = dict()
+    def _executeAction(self, actionId):
+        startTime = time.perf_counter()
+        try:
+            indigo.actionGroup.execute(actionId)
+            return 'executed', time.perf_counter() - startTime
+        except Exception as e:
+            if isinstance(e, ValueError) and str(e).startswith('ElementNotFoundError'):
+                return 'deleted', 0.0
+            self.logger.error(f'{self.name}: action group execute error \n{e}')
+            return 'error', 0.0
+
+    #-------------------------------------------------------------------------------
+    @staticmethod
+    def _phases(actions):
+        # split the action list into runs that may execute concurrently
+        phase = list()
+        for item in actions:
+            if phase and (not item[2] or item[2] != phase[-1][2]):
+                yield phase
+                phase = list()
+            phase.append(item)
+        if phase:
+            yield phase
+
+    #-------------------------------------------------------------------------------
+    def _queueVariable(self, varId, value):
+        self.variableDict[varId] = value
+
+    #-------------------------------------------------------------------------------
+    def _changeVariables(self, variables):
+        unchanged = self.plugin.writer.submit(variables)
+        if self.plugin.debug:
+            self.logger.debug('>>> variables:')
+            names = {varId:self.varNames.get(varId, str(varId)) for varId in variables}
+            pad = max([len(name) for name in names.values()] or [0]) + 1
+            for varId, value in variables.items():
+                self.logger.debug('    %-*s: %s%s', pad, names[varId], value, ['',' (unchanged)'][varId in unchanged])
+        self.logger.debug('    %d written, %d skipped', len(variables)-len(unchanged), len(unchanged))
+        return len(variables) - len(unchanged)
+
+    #-------------------------------------------------------------------------------
+    def _getLeaf(self, path):
+        leaf = self.leaves.get(path)
+        if leaf is None:
+            leaf = self.leaves[path] = StateLeaf(self, path)
+        return leaf
+
+    #-------------------------------------------------------------------------------
+    def _getBranch(self, state):
+        branch = self.branches.get(state)
+        if branch is None:
+            branch = self.branches[state] = StateBranch(self, state)
+        return branch
+
+    #-------------------------------------------------------------------------------
+    def footprint(self, seen):
+        # approximate deep size of the in-memory model; shared objects are counted once
+        def sizeOf(obj):
+            if id(obj) in seen or obj is self:
+                return 0
+            seen.add(id(obj))
+            size = sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                size += sum(sizeOf(key) + sizeOf(value) for key, value in list(obj.items()))
+            elif isinstance(obj, (list, tuple, set)):
+                size += sum(sizeOf(item) for item in list(obj))
+            elif hasattr(obj, '__slots__'):
+                size += sum(sizeOf(getattr(obj, slot)) for slot in obj.__slots__ if hasattr(obj, slot))
+            return size
+        return {'leaves'    : sizeOf(self.leaves),
+                'branches'  : sizeOf(self.branches),
+                'variables' : sizeOf(self.varIds) + sizeOf(self.varNames),
+                'contexts'  : sizeOf(self.contexts) + sizeOf(self.groups) + sizeOf(self.contextGroups),
+                'plans'     : sizeOf(self.plans),
+                'metrics'   : sizeOf(self.metrics),
+                }
+
+    #-------------------------------------------------------------------------------
+    def _getVarId(self, name, double_underscores=False):
+        varId = self.varIds.get(name)
+        if varId is None:
+            var = self._getVar(name, double_underscores)
+            varId = self.varIds[name] = var.id
+            self.varNames[varId] = var.name
+            self.plugin.shadow[varId] = var.value
+        return varId
+
+    #-------------------------------------------------------------------------------
+    def _forgetVar(self, varId):
+        # variable was renamed, moved or deleted: look it up again on next use
+        with self.lock:
+            self.varNames.pop(varId, None)
+            for name in [name for name, cachedId in self.varIds.items() if cachedId == varId]:
+                del self.varIds[name]
+                self._clearPlans()
+            for leaf in self.leaves.values():
+                if leaf._varId == varId:
+                    leaf._varId = None
+
+    #-------------------------------------------------------------------------------
+    def _contextVarId(self, context):
+        return self._getVarId(self.name+kContextExtra+context, double_underscores=True)
+
+    #-------------------------------------------------------------------------------
+    @property
+    def lastVarId(self):
+        return self._getVarId(self.name)
+
+    #-------------------------------------------------------------------------------
+    @property
+    def priorVarId(self):
+        return self._getVarId(self.name+kPriorSuffix, double_underscores=True)
+
+    #-------------------------------------------------------------------------------
+    @property
+    def changedVarId(self):
+        return self._getVarId(self.name+kChangedSuffix, double_underscores=True)
+
+    #-------------------------------------------------------------------------------
+    @property
+    def contextVarId(self):
+        return self._getVarId(self.name+kContextSuffix, double_underscores=True)
 
     #-------------------------------------------------------------------------------
     def _getVar(self, name, double_underscores=False):
@@ -538,6 +1756,17 @@ class StateTree(object):
             folder = indigo.variables.folders[self.name]
         return folder.id
 
+    #-------------------------------------------------------------------------------
+    @property
+    def state(self):
+        with self.lock:
+            return dict(lastState  = self.lastState,
+                        priorState = self.priorState,
+                        contexts   = list(self.contexts),
+                        groups     = {group:list(items) for group, items in self.groups.items()},
+                        options    = dict(self.options),
+                        timers     = {key:list(timer) for key, timer in self.timers.items()})
+
     #-------------------------------------------------------------------------------
     @property
     def _contextListString(self):
@@ -545,37 +1774,489 @@ class StateTree(object):
 
 ################################################################################
 class StateBranch(object):
+    __slots__ = ('state','leaves')
 
     #-------------------------------------------------------------------------------
     def __init__(self, tree, state):
+        self.state = sys.intern(state)
         leaves = list()
         if state:
             names = state.split(kStateChar)
             leaf  = ""
             for name in names:
                 leaf += name
-                leaves.append(StateLeaf(tree, leaf))
+                leaves.append(tree._getLeaf(leaf))
                 leaf += kStateChar
         self.leaves = tuple(leaves)
 
 ################################################################################
 class StateLeaf(object):
+    __slots__ = ('tree','name','actionName','exitName','_varId')
 
     #-------------------------------------------------------------------------------
     def __init__(self, tree, leaf):
         self.tree       = tree
-        self.name       = leaf
-        self.actionName = tree.name+kBaseChar+leaf
-        self.var        = tree._getVar(self.actionName)
+        self.name       = sys.intern(leaf)
+        self.actionName = sys.intern(tree.name+kBaseChar+leaf)
+        self.exitName   = sys.intern(self.actionName+kExitChar)
+        self._varId     = tree._getVarId(self.actionName)
+
+    #-------------------------------------------------------------------------------
+    @property
+    def varId(self):
+        # cleared by the tree when the variable is renamed, moved or deleted
+        if self._varId is None:
+            self._varId = self.tree._getVarId(self.actionName)
+        return self._varId
 
     #-------------------------------------------------------------------------------
     def _setAction(self, enterExitBool):
-        self.tree._queueVariable(self.var, enterExitBool)
+        self.tree._queueVariable(self.varId, enterExitBool)
         if enterExitBool == kEnter: self.tree._queueAction(self.actionName)
+        # a leaf's context action groups form one phase, between its enter and exit groups
+        phase = next(self.tree.plugin.phaseIds)
         for context in self.tree.contexts:
-            self._setContext(context, enterExitBool)
-        if enterExitBool == kExit: self.tree._queueAction(self.actionName+kExitChar)
+            self._setContext(context, enterExitBool, phase)
+        if enterExitBool == kExit: self.tree._queueAction(self.exitName)
 
     #-------------------------------------------------------------------------------
-    def _setContext(self, context, enterExitBool):
-        self.tree._queueAction(self.actionName+kContextChar+context+[kExitChar,''][enterExitBool])
+    def _setContext(self, context, enterExitBool, phase=0):
+        self.tree._queueAction(self.actionName+kContextChar+context+[kExitChar,''][enterExitBool], phase)
+
+################################################################################
+class ActionJob(object):
+    __slots__ = ('actions','variables','fromBranch','summary')
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, actions, variables, fromBranch=None, summary=None):
+        self.actions    = actions
+        self.variables  = variables
+        self.fromBranch = fromBranch    # set for state changes, which may be coalesced
+        self.summary    = summary       # one-line log of the transition, if enabled
+
+################################################################################
+class ActionQueue(object):
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, tree):
+        self.tree      = tree
+        self.jobs      = deque()
+        self.condition = threading.Condition()
+        self.stopEvent = threading.Event()
+        self.busy      = False
+        self.thread    = threading.Thread(target=self._run, name=f'StateTree {tree.name}', daemon=True)
+        self.thread.start()
+
+    #-------------------------------------------------------------------------------
+    def submit(self, job):
+        with self.condition:
+            self.jobs.append(job)
+            self.condition.notify_all()
+
+    #-------------------------------------------------------------------------------
+    def waitIdle(self, timeout=10.0):
+        # true once every queued job has finished; the worker keeps running
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.jobs and not self.busy, timeout)
+
+    #-------------------------------------------------------------------------------
+    def takeStateJob(self):
+        # remove and return the last queued job if it is a state change not yet started
+        with self.condition:
+            if self.jobs and self.jobs[-1] is not None and self.jobs[-1].fromBranch is not None:
+                return self.jobs.pop()
+
+    #-------------------------------------------------------------------------------
+    def stop(self, timeout=10.0, hurry=False):
+        self.signal(hurry)
+        self.join(timeout)
+
+    #-------------------------------------------------------------------------------
+    def signal(self, hurry=False):
+        # let queued jobs finish, then end the worker; hurry skips their sleeps
+        with self.condition:
+            self.jobs.append(None)
+            self.condition.notify_all()
+        if hurry:
+            self.stopEvent.set()
+
+    #-------------------------------------------------------------------------------
+    def join(self, timeout=10.0):
+        self.thread.join(timeout)
+
+    #-------------------------------------------------------------------------------
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                job = self.jobs.popleft()
+                self.busy = job is not None
+            if job is None:
+                break
+            try:
+                self.tree._runJob(job, self.stopEvent.wait)
+            except Exception as e:
+                self.tree.logger.error(f'{self.tree.name}: action queue error \n{e}')
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+################################################################################
+class TimerScheduler(object):
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, logger):
+        self.logger    = logger
+        self.heap      = list()
+        self.entries   = dict()
+        self.sequence  = count()
+        self.condition = threading.Condition()
+        self.running   = True
+        self.queues    = dict()     # namespace: due callbacks waiting for the pool
+        self.pool      = ThreadPoolExecutor(kTimerWorkers, thread_name_prefix='StateTree timer')
+        self.thread    = threading.Thread(target=self._run, name='StateTree timers', daemon=True)
+        self.thread.start()
+
+    #-------------------------------------------------------------------------------
+    def schedule(self, delay, key, callback, *args):
+        # a new timer replaces any pending timer with the same key
+        entry = [time.time()+delay, next(self.sequence), key, callback, args]
+        with self.condition:
+            self._cancel(key)
+            self.entries[key] = entry
+            heapq.heappush(self.heap, entry)
+            self.condition.notify()
+
+    #-------------------------------------------------------------------------------
+    def cancel(self, key):
+        with self.condition:
+            return self._cancel(key)
+
+    #-------------------------------------------------------------------------------
+    def _cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            entry[3] = None     # left in the heap, skipped when due
+        return entry is not None
+
+    #-------------------------------------------------------------------------------
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.queues.clear()
+            self.condition.notify()
+        self.thread.join(5.0)
+        self.pool.shutdown(wait=False)
+
+    #-------------------------------------------------------------------------------
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.heap or self.heap[0][0] > time.time()):
+                    self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+                if not self.running:
+                    break
+                when, seq, key, callback, args = heapq.heappop(self.heap)
+                if callback is None:
+                    continue
+                del self.entries[key]
+                self._dispatch(key, callback, args)
+
+    #-------------------------------------------------------------------------------
+    def _dispatch(self, key, callback, args):
+        # keys start with the namespace: its callbacks run in order, other namespaces alongside
+        queue = self.queues.get(key[0])
+        if queue is not None:
+            queue.append((key, callback, args))
+        else:
+            self.queues[key[0]] = deque([(key, callback, args)])
+            self.pool.submit(self._drain, key[0])
+
+    #-------------------------------------------------------------------------------
+    def _drain(self, name):
+        while True:
+            with self.condition:
+                queue = self.queues.get(name)
+                if not queue:
+                    self.queues.pop(name, None)
+                    return
+                key, callback, args = queue.popleft()
+            try:
+                callback(*args)
+            except Exception as e:
+                self.logger.error(f'timer {key} error \n{e}')
+
+################################################################################
+class VariableWriter(object):
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, plugin):
+        self.plugin    = plugin
+        self.logger    = plugin.logger
+        self.shadow    = plugin.shadow
+        self.pending   = dict()
+        self.condition = threading.Condition()
+        self.writeLock = threading.Lock()   # keeps writes in submission order across threads
+        self.rate      = 0.0
+        self.running   = False
+        self.thread    = None
+
+    #-------------------------------------------------------------------------------
+    def setRate(self, rate):
+        # rate 0 writes in the caller's thread, otherwise a writer thread paces them
+        if not rate and self.running:
+            self.stop()
+        self.rate = rate
+        if rate and not self.running:
+            self.running = True
+            self.thread  = threading.Thread(target=self._run, name='StateTree variables', daemon=True)
+            self.thread.start()
+
+    #-------------------------------------------------------------------------------
+    def submit(self, variables):
+        # merge by variable, last write wins; returns ids already holding their value
+        unchanged = set()
+        plugin = self.plugin
+        with self.condition:
+            for varId, value in variables.items():
+                value = str(value)
+                if varId in self.pending:
+                    plugin.mergedCount += 1
+                    if self.shadow.get(varId) == value:
+                        del self.pending[varId]     # back to the value already written
+                    else:
+                        self.pending[varId] = value
+                elif self.shadow.get(varId) == value:
+                    unchanged.add(varId)
+                else:
+                    self.pending[varId] = value
+            plugin.unchangedCount += len(unchanged)
+            if self.running:
+                self.condition.notify()
+        if not self.running:
+            self.flush()
+        return unchanged
+
+    #-------------------------------------------------------------------------------
+    def flush(self):
+        with self.writeLock:
+            with self.condition:
+                pending, self.pending = self.pending, dict()
+            self._write(pending.items())
+
+    #-------------------------------------------------------------------------------
+    def discard(self, varId):
+        with self.condition:
+            self.pending.pop(varId, None)
+
+    #-------------------------------------------------------------------------------
+    def stop(self):
+        if self.running:
+            with self.condition:
+                self.running = False
+                self.condition.notify()
+            self.thread.join(5.0)
+        self.flush()
+
+    #-------------------------------------------------------------------------------
+    def _write(self, items):
+        for varId, value in items:
+            try:
+                indigo.variable.updateValue(varId, value)
+                self.shadow[varId] = value
+                self.plugin.writeCount += 1
+            except Exception as e:
+                self.logger.error(f'variable {varId} update error \n{e}')
+
+    #-------------------------------------------------------------------------------
+    def _run(self):
+        # token bucket: earns rate writes per second, holding at most one interval's worth
+        tokens = 1.0
+        last = time.monotonic()
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    break
+            now = time.monotonic()
+            tokens = min(max(1.0, self.rate * kWriteInterval), tokens + (now - last) * self.rate)
+            last = now
+            if tokens < 1.0:
+                time.sleep((1.0 - tokens) / self.rate)
+                continue
+            with self.writeLock:
+                with self.condition:
+                    batch = [(varId, self.pending.pop(varId)) for varId in list(islice(self.pending, int(tokens)))]
+                self._write(batch)
+            tokens -= len(batch)
+
+################################################################################
+class Histogram(object):
+    __slots__ = ('counts','total','max')
+
+    #-------------------------------------------------------------------------------
+    def __init__(self):
+        self.counts = [0] * (len(kMetricsBounds) + 1)
+        self.total  = 0.0
+        self.max    = 0.0
+
+    #-------------------------------------------------------------------------------
+    def add(self, seconds):
+        self.counts[bisect_left(kMetricsBounds, seconds)] += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    #-------------------------------------------------------------------------------
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    #-------------------------------------------------------------------------------
+    @property
+    def mean(self):
+        count = self.count
+        return self.total / count if count else 0.0
+
+    #-------------------------------------------------------------------------------
+    def percentile(self, pct):
+        # upper bound of the bucket holding the value, never more than the max seen
+        target = self.count * pct / 100.0
+        seen = 0
+        for bound, n in zip(kMetricsBounds + (self.max,), self.counts):
+            seen += n
+            if n and seen >= target:
+                return min(bound, self.max)
+        return 0.0
+
+    #-------------------------------------------------------------------------------
+    def export(self):
+        return {'count':self.count, 'total':self.total, 'max':self.max, 'counts':list(self.counts)}
+
+################################################################################
+class TreeMetrics(object):
+    __slots__ = ('stateChange','contextChange','lockWait','execute','hookTime','missing','deleted','slept','hooks')
+
+    #-------------------------------------------------------------------------------
+    def __init__(self):
+        self.stateChange   = Histogram()
+        self.contextChange = Histogram()
+        self.lockWait      = Histogram()
+        self.execute       = Histogram()
+        self.hookTime      = Histogram()
+        self.missing       = 0
+        self.deleted       = 0
+        self.slept         = 0.0
+        self.hooks         = dict()     # action group name -> [count, total, max]
+
+    #-------------------------------------------------------------------------------
+    def addHook(self, name, seconds):
+        self.hookTime.add(seconds)
+        hook = self.hooks.get(name)
+        if hook is None:
+            # keep the table bounded by dropping the hook with least total time
+            if len(self.hooks) >= kMetricsHooks:
+                del self.hooks[min(self.hooks, key=lambda key: self.hooks[key][1])]
+            hook = self.hooks[name] = [0, 0.0, 0.0]
+        hook[0] += 1
+        hook[1] += seconds
+        if seconds > hook[2]:
+            hook[2] = seconds
+
+    #-------------------------------------------------------------------------------
+    def slowestHooks(self, count):
+        return sorted(self.hooks.items(), key=lambda item: item[1][1]/item[1][0], reverse=True)[:count]
+
+    #-------------------------------------------------------------------------------
+    def export(self):
+        return {'stateChange'   : self.stateChange.export(),
+                'contextChange' : self.contextChange.export(),
+                'lockWait'      : self.lockWait.export(),
+                'execute'       : self.execute.export(),
+                'actionGroups'  : self.hookTime.export(),
+                'missing'       : self.missing,
+                'deleted'       : self.deleted,
+                'slept'         : self.slept,
+                'hooks'         : {name:list(hook) for name, hook in list(self.hooks.items())},
+                }
+
+################################################################################
+class StateJournal(object):
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, folder, getStates):
+        os.makedirs(folder, exist_ok=True)
+        self.journalPath  = os.path.join(folder, kJournalFile)
+        self.snapshotPath = os.path.join(folder, kSnapshotFile)
+        self.getStates    = getStates
+        self.lock         = threading.Lock()
+        self.compactLock  = threading.Lock()
+        self.file         = open(self.journalPath, 'a')
+        self.count        = 0
+        self.compactDue   = False
+
+    #-------------------------------------------------------------------------------
+    def load(self, states):
+        # snapshot (if any) replaces pluginPrefs, then replay the journal tail,
+        # including one set aside by a compaction that did not finish
+        try:
+            with open(self.snapshotPath) as f:
+                states = json.load(f)
+        except (OSError, ValueError):
+            pass
+        for path in (self.journalPath + '.old', self.journalPath):
+            try:
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            break   # torn write from a crash
+                        if record['set'] is None:
+                            states.pop(record['ns'], None)
+                        else:
+                            states.setdefault(record['ns'], dict()).update(record['set'])
+            except OSError:
+                pass
+        return states
+
+    #-------------------------------------------------------------------------------
+    def append(self, namespace, changes):
+        with self.lock:
+            self.file.write(json.dumps({'t':time.time(), 'ns':namespace, 'set':changes}, separators=(',',':')) + '\n')
+            self.file.flush()
+            self.count += 1
+            if self.count >= kJournalCompact:
+                self.compactDue = True  # callers may hold a namespace lock, so not here
+
+    #-------------------------------------------------------------------------------
+    def compact(self):
+        # set the journal aside first, so changes made while namespace states are
+        # read (each under its own lock) land in the fresh journal and replay after
+        with self.compactLock:
+            oldPath = self.journalPath + '.old'
+            with self.lock:
+                self.file.close()
+                if os.path.exists(oldPath):
+                    # an earlier compaction did not finish: keep both tails, in order
+                    with open(oldPath, 'a') as old, open(self.journalPath) as f:
+                        old.write(f.read())
+                    os.remove(self.journalPath)
+                else:
+                    os.replace(self.journalPath, oldPath)
+                self.file       = open(self.journalPath, 'w')
+                self.count      = 0
+                self.compactDue = False
+            tempPath = self.snapshotPath + '.tmp'
+            with open(tempPath, 'w') as f:
+                json.dump(self.getStates(), f)
+            os.replace(tempPath, self.snapshotPath)
+            os.remove(oldPath)
+
+    #-------------------------------------------------------------------------------
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,300 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Offline benchmark for the State Tree Actions plugin.
+# Runs scripted workloads against plugin.py using the stand-in indigo module in
+# this folder, and reports transitions/sec, Indigo calls per transition and
+# p50/p99 latency. Save a run with --json and compare later runs with --baseline.
+#
+#   python3 benchmarks/bench.py
+#   python3 benchmarks/bench.py --latency 2 --async --json before.json
+#   python3 benchmarks/bench.py --latency 2 --async --baseline before.json
+#
+# Only the plugin's action and menu API is required, so an older plugin.py can be
+# measured with --plugin for a baseline:
+#
+#   git show <commit>:"State Tree Actions.indigoPlugin/Contents/Server Plugin/plugin.py" > /tmp/old.py
+#   python3 benchmarks/bench.py --plugin /tmp/old.py --json before.json
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+kBenchFolder = os.path.dirname(os.path.abspath(__file__))
+kPluginFile  = os.path.join(kBenchFolder, '..', 'State Tree Actions.indigoPlugin',
+                            'Contents', 'Server Plugin', 'plugin.py')
+
+sys.path.insert(0, kBenchFolder)
+import indigo
+
+###############################################################################
+def loadPlugin(path):
+    spec = importlib.util.spec_from_file_location('plugin', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+#-------------------------------------------------------------------------------
+def makeHooks(namespace, states, contexts):
+    # every action group the plugin could look for, so nothing counts as missing
+    names = {namespace, namespace+'*'}
+    for context in contexts:
+        names.update((f'{namespace}+{context}', f'{namespace}+{context}*'))
+    for state in states:
+        parts = state.split('>')
+        for i in range(len(parts)):
+            leaf = f'{namespace}|' + '>'.join(parts[:i+1])
+            names.update((leaf, leaf+'*'))
+            for context in contexts:
+                names.update((f'{leaf}+{context}', f'{leaf}+{context}*'))
+    for name in names - set(indigo.actionGroups):
+        indigo.actionGroup.create(name)
+
+#-------------------------------------------------------------------------------
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values)-1, int(round(pct/100.0*(len(values)-1))))]
+
+################################################################################
+class Workload(object):
+    name = ''
+    description = ''
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, plugin, scale):
+        self.plugin = plugin
+        self.scale  = scale
+
+    #-------------------------------------------------------------------------------
+    def addNamespace(self, namespace, states=(), contexts=(), groups=None):
+        makeHooks(namespace, states, contexts)
+        self.plugin.changeNamespace({'baseName':namespace}, 'addNamespace')
+        for group, items in (groups or {}).items():
+            self.plugin.changeContextGroup({'baseName':namespace, 'groupName':group,
+                                            'groupString':','.join(items)}, 'addContextGroup')
+        return self.plugin.treeDict[namespace]
+
+    #-------------------------------------------------------------------------------
+    def setup(self):
+        pass
+
+    #-------------------------------------------------------------------------------
+    def operations(self):
+        return ()
+
+################################################################################
+class DeepTree(Workload):
+    name = 'deep'
+    description = 'state changes between branches of a 10-level tree'
+
+    def setup(self):
+        self.states = list()
+        for branch in 'abcd':
+            self.states.append('>'.join(f'{branch}{level}' for level in range(10)))
+        self.states.append('a0>a1>a2>a3>x4>x5')
+        self.tree = self.addNamespace('deep', self.states, ('ctx',))
+        self.tree.contextChange('ctx', True)
+
+    def operations(self):
+        for i in range(self.scale):
+            yield self.tree.stateChange, (self.states[i % len(self.states)],)
+
+################################################################################
+class ManyContexts(Workload):
+    name = 'contexts'
+    description = 'state changes with 25 active contexts on a 4-level tree'
+
+    def setup(self):
+        self.states = ['a>b>c>d', 'a>b>x>y', 'q>r', 'a']
+        contexts = [f'c{i}' for i in range(25)]
+        self.tree = self.addNamespace('ctxs', self.states, contexts)
+        for context in contexts:
+            self.tree.contextChange(context, True)
+
+    def operations(self):
+        for i in range(self.scale):
+            yield self.tree.stateChange, (self.states[i % len(self.states)],)
+
+################################################################################
+class LargeGroup(Workload):
+    name = 'groups'
+    description = 'adding members of a 50-context exclusive group in turn'
+
+    def setup(self):
+        self.contexts = [f'm{i}' for i in range(50)]
+        self.tree = self.addNamespace('grp', ['a>b>c'], self.contexts, {'mode':self.contexts})
+        self.tree.stateChange('a>b>c')
+
+    def operations(self):
+        for i in range(self.scale):
+            yield self.tree.contextChange, (self.contexts[i % len(self.contexts)], True)
+
+################################################################################
+class ManyNamespaces(Workload):
+    name = 'namespaces'
+    description = 'state changes spread across 300 namespaces'
+
+    def setup(self):
+        self.states = ['a>b', 'a>c', 'd']
+        self.trees = [self.addNamespace(f'ns{i}', self.states, ('occ',)) for i in range(300)]
+
+    def operations(self):
+        for i in range(self.scale):
+            yield self.trees[i % len(self.trees)].stateChange, (self.states[(i // len(self.trees)) % len(self.states)],)
+
+################################################################################
+class BurstyToggles(Workload):
+    name = 'burst'
+    description = 'rapid random context toggles and state flips in one namespace'
+
+    def setup(self):
+        self.states = ['home>day', 'home>night', 'away']
+        self.contexts = ['guest', 'occupied', 'dark', 'music']
+        self.tree = self.addNamespace('burst', self.states, self.contexts)
+        self.random = random.Random(1)
+
+    def operations(self):
+        for i in range(self.scale):
+            if self.random.random() < 0.2:
+                yield self.tree.stateChange, (self.random.choice(self.states),)
+            else:
+                yield self.tree.contextToggle, (self.random.choice(self.contexts),)
+
+################################################################################
+class SyncVariables(Workload):
+    name = 'sync'
+    description = 'syncVariables on a namespace with 40 contexts and stray variables'
+
+    def setup(self):
+        contexts = [f'c{i}' for i in range(40)]
+        self.tree = self.addNamespace('sync', ['a>b>c'], contexts)
+        self.tree.stateChange('a>b>c')
+        for context in contexts:
+            self.tree.contextChange(context, True)
+        for i in range(40):
+            indigo.variable.create(f'stray_{i}', '', self.tree.folder)
+
+    def operations(self):
+        for i in range(max(1, self.scale // 20)):
+            yield self.tree.syncVariables, ()
+
+kWorkloads = (DeepTree, ManyContexts, LargeGroup, ManyNamespaces, BurstyToggles, SyncVariables)
+
+###############################################################################
+def drain(plugin):
+    # wait for queued work in plugins that have it; older plugins finish inline
+    for tree in plugin.treeDict.values():
+        if hasattr(tree, 'stopExecution'):
+            tree.stopExecution()
+    if hasattr(plugin, 'writer'):
+        plugin.writer.flush()
+    if getattr(plugin, 'saveDue', None):
+        plugin.saveNamespaceStates()
+        indigo.server.savePluginPrefs()
+
+#-------------------------------------------------------------------------------
+def runWorkload(module, workloadClass, args):
+    prefs = indigo.Dict(asyncActions=args.asyncActions, warmUp=False, saveDelay=args.saveDelay,
+                        useJournal=args.journal, actionSleep=0,
+                        parallelActions=args.parallel > 1, parallelLimit=max(args.parallel, 1),
+                        variableRate=args.writeRate)
+    plugin = module.Plugin('com.benchmark', 'State Tree Actions', 'bench', prefs)
+    plugin.startup()
+    workload = workloadClass(plugin, args.transitions)
+    workload.setup()
+    drain(plugin)
+
+    indigo.reset()
+    indigo.setLatency(args.latency / 1000.0)
+    timings = list()
+    startTime = time.perf_counter()
+    for method, methodArgs in workload.operations():
+        opStart = time.perf_counter()
+        method(*methodArgs)
+        timings.append(time.perf_counter() - opStart)
+    drain(plugin)
+    elapsed = time.perf_counter() - startTime
+    indigo.setLatency(0.0)
+
+    plugin.shutdown()
+    count = len(timings)
+    return dict(
+        workload    = workload.name,
+        count       = count,
+        perSecond   = count / elapsed,
+        calls       = sum(indigo.calls.values()) / count,
+        executes    = indigo.calls['actionGroup.execute'] / count,
+        writes      = indigo.calls['variable.updateValue'] / count,
+        p50         = percentile(timings, 50) * 1000,
+        p99         = percentile(timings, 99) * 1000,
+        )
+
+#-------------------------------------------------------------------------------
+def report(results, baseline, out):
+    header = f'{"workload":<11} {"ops":>6} {"ops/sec":>10} {"calls/op":>9} {"exec/op":>8} {"write/op":>9} {"p50 ms":>8} {"p99 ms":>8}'
+    out(header)
+    out('-' * len(header))
+    for result in results:
+        out(f'{result["workload"]:<11} {result["count"]:>6} {result["perSecond"]:>10.1f} {result["calls"]:>9.2f} '
+            f'{result["executes"]:>8.2f} {result["writes"]:>9.2f} {result["p50"]:>8.3f} {result["p99"]:>8.3f}')
+        before = baseline.get(result['workload'])
+        if before:
+            out(f'{"  vs base":<11} {"":>6} {result["perSecond"]/before["perSecond"]-1:>+10.1%} '
+                f'{result["calls"]-before["calls"]:>+9.2f} {result["executes"]-before["executes"]:>+8.2f} '
+                f'{result["writes"]-before["writes"]:>+9.2f} {result["p50"]-before["p50"]:>+8.3f} {result["p99"]-before["p99"]:>+8.3f}')
+
+###############################################################################
+def main():
+    parser = argparse.ArgumentParser(description='Offline State Tree Actions benchmark')
+    parser.add_argument('workloads', nargs='*', metavar='workload',
+                        help='workloads to run: ' + ', '.join(w.name for w in kWorkloads) + ' (default all)')
+    parser.add_argument('-n', '--transitions', type=int, default=500, help='operations per workload')
+    parser.add_argument('-l', '--latency', type=float, default=0.0, help='simulated ms per Indigo call')
+    parser.add_argument('--async', dest='asyncActions', action='store_true', help='run action groups on namespace workers')
+    parser.add_argument('--parallel', type=int, default=0, metavar='N', help='run context action groups N at a time')
+    parser.add_argument('--write-rate', dest='writeRate', type=float, default=0.0, metavar='N',
+                        help='merge variable writes and pace them to N per second')
+    parser.add_argument('--journal', action='store_true', help='persist namespace states to the journal')
+    parser.add_argument('--save-delay', dest='saveDelay', type=float, default=2.0, help='plugin prefs save delay')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--baseline', help='compare against results saved with --json')
+    parser.add_argument('--output', help='also append the report to this file')
+    parser.add_argument('--plugin', default=kPluginFile, help='plugin.py to measure (default: this checkout)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show plugin log output')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL, format='%(message)s')
+    workloads = {w.name:w for w in kWorkloads}
+    selected = args.workloads or list(workloads)
+    for name in selected:
+        if name not in workloads:
+            parser.error(f'unknown workload "{name}"')
+
+    module = loadPlugin(args.plugin)
+    results = [runWorkload(module, workloads[name], args) for name in selected]
+
+    baseline = dict()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {result['workload']:result for result in json.load(f)['results']}
+
+    lines = list()
+    lines.append(f'latency {args.latency} ms/call, {"async" if args.asyncActions else "inline"} actions'
+                 + (f', parallel {args.parallel}' if args.parallel > 1 else '')
+                 + (f', {args.writeRate:g} writes/sec' if args.writeRate else '') + (', journal' if args.journal else ''))
+    report(results, baseline, lines.append)
+    print('\n'.join(lines))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write('\n'.join(lines) + '\n\n')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args':vars(args), 'results':results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# In-process stand-in for the Indigo server's "indigo" module.
+# Models just enough of variables, variable folders, action groups and the
+# server for plugin.py to run under plain CPython. Every call that would be a
+# round trip to the Indigo server is counted and may be given a fixed latency.
+
+import copy
+import datetime
+import itertools
+import logging
+import tempfile
+import threading
+import time
+from collections import Counter
+
+###############################################################################
+# call accounting
+
+calls    = Counter()
+latency  = 0.0
+executed = list()
+_ids     = itertools.count(1000)
+_lock    = threading.RLock()
+
+def setLatency(seconds):
+    global latency
+    latency = seconds
+
+def reset():
+    calls.clear()
+    del executed[:]
+
+def _call(kind):
+    calls[kind] += 1
+    if latency:
+        time.sleep(latency)
+
+###############################################################################
+# basic types
+
+class Dict(dict):
+    pass
+
+class List(list):
+    pass
+
+class _Element(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+################################################################################
+class _Collection(object):
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, kind):
+        self.kind       = kind
+        self.elements   = dict()
+        self.listener   = None
+
+    #-------------------------------------------------------------------------------
+    def iter(self, filter=None):
+        _call(f'{self.kind}.iter')
+        with _lock:
+            return iter([copy.copy(element) for element in self.elements.values()])
+
+    #-------------------------------------------------------------------------------
+    def __iter__(self):
+        return iter(list(self.elements))
+
+    #-------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.elements)
+
+    #-------------------------------------------------------------------------------
+    def __getitem__(self, key):
+        _call(f'{self.kind}.get')
+        return copy.copy(self._find(key))
+
+    #-------------------------------------------------------------------------------
+    def __contains__(self, key):
+        _call(f'{self.kind}.contains')
+        try:
+            self._find(key)
+            return True
+        except KeyError:
+            return False
+
+    #-------------------------------------------------------------------------------
+    def _find(self, key):
+        with _lock:
+            if isinstance(key, int):
+                return self.elements[key]
+            for element in self.elements.values():
+                if element.name == key:
+                    return element
+        raise KeyError(key)
+
+    #-------------------------------------------------------------------------------
+    def _add(self, element):
+        with _lock:
+            self.elements[element.id] = element
+        self._fire('Created', copy.copy(element))
+        return copy.copy(element)
+
+    #-------------------------------------------------------------------------------
+    def _fire(self, event, *args):
+        if self.listener:
+            getattr(self.listener, self.kind[:-1]+event)(*args)
+
+    #-------------------------------------------------------------------------------
+    def subscribeToChanges(self):
+        self.listener = _plugin[0]
+
+################################################################################
+class _VariableFolders(_Collection):
+
+    #-------------------------------------------------------------------------------
+    def create(self, name):
+        _call('variables.folder.create')
+        with _lock:
+            folder = _Element(id=next(_ids), name=name)
+            self.elements[folder.id] = folder
+        return copy.copy(folder)
+
+variables         = _Collection('variables')
+variables.folders = _VariableFolders('folders')
+variables.folder  = variables.folders
+
+################################################################################
+class _VariableCommands(object):
+
+    #-------------------------------------------------------------------------------
+    def create(self, name, value="", folder=0):
+        _call('variable.create')
+        return variables._add(_Element(id=next(_ids), name=name, value=str(value), folderId=folder))
+
+    #-------------------------------------------------------------------------------
+    def updateValue(self, var, value):
+        _call('variable.updateValue')
+        self._change(var, value=str(value))
+
+    #-------------------------------------------------------------------------------
+    def moveToFolder(self, var, value=0):
+        _call('variable.moveToFolder')
+        self._change(var, folderId=value)
+
+    #-------------------------------------------------------------------------------
+    def delete(self, var):
+        _call('variable.delete')
+        with _lock:
+            element = variables.elements.pop(getattr(var, 'id', var))
+        variables._fire('Deleted', element)
+
+    #-------------------------------------------------------------------------------
+    def _change(self, var, **changes):
+        with _lock:
+            element = variables.elements[getattr(var, 'id', var)]
+            original = copy.copy(element)
+            element.__dict__.update(changes)
+        variables._fire('Updated', original, copy.copy(element))
+
+variable = _VariableCommands()
+
+################################################################################
+class _ActionGroupCommands(object):
+
+    #-------------------------------------------------------------------------------
+    def execute(self, group):
+        _call('actionGroup.execute')
+        try:
+            executed.append(actionGroups._find(group).name)
+        except KeyError:
+            raise ValueError(f'ElementNotFoundError -- {group}')
+
+    #-------------------------------------------------------------------------------
+    def create(self, name):
+        return actionGroups._add(_Element(id=next(_ids), name=name))
+
+actionGroups = _Collection('actionGroups')
+actionGroup  = _ActionGroupCommands()
+
+################################################################################
+class _Server(object):
+
+    #-------------------------------------------------------------------------------
+    def __init__(self):
+        self.installFolder = tempfile.mkdtemp(prefix='indigo-')
+
+    #-------------------------------------------------------------------------------
+    def getTime(self):
+        return datetime.datetime.now()
+
+    #-------------------------------------------------------------------------------
+    def savePluginPrefs(self):
+        _call('server.savePluginPrefs')
+
+    #-------------------------------------------------------------------------------
+    def getInstallFolderPath(self):
+        return self.installFolder
+
+server = _Server()
+
+################################################################################
+_plugin = [None]
+
+class PluginBase(object):
+
+    class StopThread(Exception):
+        pass
+
+    #-------------------------------------------------------------------------------
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        _plugin[0]          = self
+        self.pluginId       = pluginId
+        self.pluginPrefs    = pluginPrefs
+        self.logger         = logging.getLogger('Plugin')
+        self.stopThread     = False
+        self.debug          = False
+
+    #-------------------------------------------------------------------------------
+    def __del__(self):
+        pass
+
+    #-------------------------------------------------------------------------------
+    def sleep(self, seconds):
+        if self.stopThread:
+            raise self.StopThread()
+        time.sleep(seconds)
+
+    #-------------------------------------------------------------------------------
+    # default change handlers, as provided by the real PluginBase
+    #-------------------------------------------------------------------------------
+    def variableCreated(self, var):
+        pass
+
+    def variableUpdated(self, origVar, newVar):
+        pass
+
+    def variableDeleted(self, var):
+        pass
+
+    def actionGroupCreated(self, group):
+        pass
+
+    def actionGroupUpdated(self, origGroup, newGroup):
+        pass
+
+    def actionGroupDeleted(self, group):
+        pass
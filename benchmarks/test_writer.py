@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Checks that paced variable writes stay within the configured rate.
+#
+#   python3 -m unittest discover benchmarks
+
+import logging
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import indigo
+from bench import kPluginFile, loadPlugin
+
+plugin = loadPlugin(kPluginFile)
+
+################################################################################
+class StandIn(object):
+    def __init__(self):
+        self.logger         = logging.getLogger('Plugin')
+        self.shadow         = dict()
+        self.mergedCount    = 0
+        self.unchangedCount = 0
+        self.writeCount     = 0
+
+################################################################################
+class VariableRateTest(unittest.TestCase):
+
+    #-------------------------------------------------------------------------------
+    def measure(self, rate, seconds):
+        owner  = StandIn()
+        writer = plugin.VariableWriter(owner)
+        varIds = [indigo.variable.create(f'rate_{rate}_{i}').id for i in range(int(rate*seconds)+50)]
+        writer.setRate(rate)
+        try:
+            writer.submit({varId:'x' for varId in varIds})
+            time.sleep(seconds)
+            return owner.writeCount
+        finally:
+            with writer.condition:
+                writer.pending.clear()
+            writer.stop()
+
+    #-------------------------------------------------------------------------------
+    def testLowRate(self):
+        # 2 per second: the first write goes at once, then one every half second
+        written = self.measure(2.0, 2.0)
+        self.assertLessEqual(written, 5)
+        self.assertGreaterEqual(written, 4)
+
+    #-------------------------------------------------------------------------------
+    def testFractionalRate(self):
+        # 25 per second is not truncated to 20
+        written = self.measure(25.0, 2.0)
+        self.assertLessEqual(written, 53)
+        self.assertGreaterEqual(written, 47)
+
+if __name__ == '__main__':
+    unittest.main()